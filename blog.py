@@ -1,19 +1,22 @@
-
 # vim:fileencoding=utf-8
 
 import os
 import re
 import email
+import email.parser
+import hashlib
 from datetime import datetime
-import genshi.template
 import lxml.etree
 
 import constance
+import cache
+import entryset
+import feeds
+import manifest
+import related
+import stats
 import viewutils
-
-template_loader = genshi.template.TemplateLoader(
-        os.path.join(os.path.realpath(os.path.dirname(__file__)), 'templates', 'blog'), 
-        variable_lookup='strict')
+from loader import template_loader
 
 def cleanup_metadata(header_items):
     cleaned = {}
@@ -29,14 +32,27 @@ def cleanup_metadata(header_items):
 class BlogEntry(object):
 
     def __init__(self, dir, name):
-        content_filename = os.path.join(dir, name + '.txt')
+        self.content_filename = os.path.join(dir, name + '.txt')
         self.id = name.decode('utf8')
-
-        # not really a MIME document, but parse it like one
-        msg = email.message_from_file(open(content_filename, 'r'))
-        self.metadata = cleanup_metadata(msg.items())
-        self.body = viewutils.markdown(msg.get_payload().decode('utf8'))
-        self.title = viewutils.mini_markdown(self.metadata['title'])
+        st = os.stat(self.content_filename)
+        self.file_state = (st.st_mtime, st.st_size)
+
+        # Only the header block is parsed up front; the body is converted 
+        # from Markdown when it is first needed (see the body property).
+        source = open(self.content_filename, 'r').read()
+        self.source_hash = hashlib.sha1(source).hexdigest()
+        self.cache_key = hashlib.sha1(self.source_hash + viewutils.MARKDOWN_SIGNATURE).hexdigest()
+        self._body = None
+        self._atom = None
+        cached = cache.get('blog-entry-header', self.cache_key)
+        if cached is None:
+            # not really a MIME document, but parse it like one
+            msg = email.parser.HeaderParser().parsestr(source.split('\n\n', 1)[0])
+            self.metadata = cleanup_metadata(msg.items())
+            self.title = viewutils.mini_markdown(self.metadata['title'])
+            cache.put('blog-entry-header', self.cache_key, (self.metadata, self.title))
+        else:
+            self.metadata, self.title = cached
 
         raw_tags = self.metadata.get('tags', '').strip()
         if raw_tags:
@@ -44,49 +60,163 @@ class BlogEntry(object):
         else:
             self.tags = frozenset()
 
-        self.modified_date = datetime.fromtimestamp(os.path.getmtime(content_filename))
+        self.modified_date = datetime.fromtimestamp(st.st_mtime)
         self.publication_date = self.metadata.get('publication-date', None) or self.modified_date
         self.guid = self.metadata['guid']
         self.language = self.metadata.get('language', None)
 
-    def generate_atom(self, config):
-        return template_loader.load('entry.atom').generate(item=self,
-                config=config)
-
-class BlogEntrySet(object):
+    @property
+    def body(self):
+        if self._body is None:
+            body = cache.get('blog-entry-body', self.cache_key)
+            if body is None:
+                msg = email.message_from_file(open(self.content_filename, 'r'))
+                body = viewutils.markdown(msg.get_payload().decode('utf8'))
+                cache.put('blog-entry-body', self.cache_key, body)
+            self._body = body
+        return self._body
+
+    def __getstate__(self):
+        # don't send rendered bodies back from worker processes
+        state = self.__dict__.copy()
+        state['_body'] = None
+        state['_atom'] = None
+        return state
 
-    def __init__(self, dir):
+    def generate_atom(self, config):
+        # rendered once per build however many feeds include this entry, and 
+        # cached on disk until the entry (including its id, which is in its 
+        # links), its templates or the config values they use change
+        key = manifest.fragment_key('blog/entry.atom', config, 
+                viewutils.ATOM_ENTRY_CONFIG, self.id, self.source_hash, 
+                self.modified_date)
+        if self._atom is None or self._atom[0] != key:
+            self._atom = (key, constance.render_fragment(template_loader, 
+                    'blog/entry.atom', key, item=self, config=config))
+        return self._atom[1]
+
+# Parsed entries from the previous build, keyed by filename, and the set of 
+# them. Only useful when the process stays resident (--watch).
+_entry_cache = {}
+_entry_set = None
+
+def load_entry(dir, name):
+    """
+    Returns the named entry, reusing the previously parsed instance if the 
+    file has not been modified since.
+    """
+    filename = os.path.join(dir, name + '.txt')
+    entry = _entry_cache.get(filename)
+    if entry is not None:
+        st = os.stat(filename)
+        if entry.file_state == (st.st_mtime, st.st_size):
+            return entry
+    with stats.timed('parse'):
+        return BlogEntry(dir, name)
+
+def entry_names(dir):
+    for filename in sorted(os.listdir(dir)):
+        m = re.match(r'([^.].*)\.txt$', filename)
+        if m:
+            yield m.group(1)
+
+class BlogEntrySet(entryset.EntrySet):
+
+    def __init__(self, dir, entries=None):
         self.dir = dir
-        self.entries = []
-        for filename in os.listdir(dir):
-            m = re.match(r'([^.].*)\.txt$', filename)
-            if m:
-                self.entries.append(BlogEntry(dir, m.group(1)))
-    
-    def __iter__(self):
-        return iter(self.entries)
-
-    def __len__(self):
-        return len(self.entries)
-
-def generate(dir, xslt, config):
-    entries = BlogEntrySet(dir)
-    
+        if entries is None:
+            entries = (BlogEntry(dir, name) for name in entry_names(dir))
+        super(BlogEntrySet, self).__init__(entries)
+
+def entry_filename(dir, entry):
+    return os.path.join(dir, entry.id.encode('utf8') + '.html')
+
+def entry_key(entry, related):
+    return manifest.key('blog/entry.html', entry.source_hash, entry.modified_date, 
+            [(other.id, other.title) for other in related])
+
+def render_entry(dir, entry, related, xslt, config):
+    """
+    Renders the entry's page, listing the given related entries, to a 
+    temporary file. Returns what constance.write_temporary returned, for 
+    constance.finish_output.
+    """
+    doc = constance.render_tree(template_loader, 'blog/entry.html', item=entry,
+            related=related, config=config)
+    return constance.write_temporary(entry_filename(dir, entry), 
+            lambda out: constance.transform(xslt, doc, out))
+
+# Each worker process compiles its own copy of the stylesheet (lxml XSLT 
+# objects cannot be pickled) and loads its own copy of the templates (from the 
+# compiled template cache), so both happen once per worker rather than once 
+# per entry. Without workers, the parent's are used.
+_render_args = None
+
+def _init_worker(dir, config):
+    global _render_args
+    xslt = lxml.etree.XSLT(lxml.etree.parse(config.get('global', 'xslt')))
+    _render_args = (dir, xslt, config)
+
+def _render_entry(entry, related):
+    dir, xslt, config = _render_args
+    return render_entry(dir, entry, related, xslt, config)
+
+def generate(dir, xslt, config, jobs=1):
+    global _entry_set, _render_args
+    # Entries are all parsed before any page is rendered, because each page 
+    # lists related entries drawn from the whole set.
+    entries = BlogEntrySet(dir, [load_entry(dir, name) for name in entry_names(dir)])
+    if _entry_set is not None:
+        entries.reuse_order(_entry_set)
+    _entry_set = entries
+    _entry_cache.clear()
+    _entry_cache.update((entry.content_filename, entry) for entry in entries)
+    related_by_id = related.related_entries(entries, 
+            config.getint('blog', 'related_entries'))
+    # only pages which are out of date are handed to the workers, so that a 
+    # build with nothing to render starts none
+    work = []
+    keys = {}
     for entry in entries:
-        rendered = template_loader.load('entry.html').generate(item=entry,
-                config=config).render('xhtml')
-        transformed = str(xslt(lxml.etree.fromstring(rendered)))
-        constance.output(os.path.join(dir, entry.id.encode('utf8') + '.html'), transformed)
+        others = related_by_id.get(entry.id, [])
+        key = entry_key(entry, others)
+        if not manifest.fresh(entry_filename(dir, entry), key):
+            work.append((entry, others))
+            keys[entry.id] = key
+
+    def collect((entry, others), written):
+        constance.finish_output(entry_filename(dir, entry), written, keys[entry.id])
+    _render_args = (dir, xslt, config)
+    constance.map_in_workers(_render_entry, work, jobs, collect, 
+            outputs=[entry_filename(dir, entry) for entry, others in work],
+            initializer=_init_worker, initargs=(dir, config))
     
-    # index
-    rendered = template_loader.load('index.html').generate(items=entries,
-            config=config).render('xhtml')
-    transformed = str(xslt(lxml.etree.fromstring(rendered)))
-    constance.output(os.path.join(dir, 'index.html'), transformed)
+    # index, with archive pages for each year and month
+    recent = entries.recent(config.getint('blog', 'index_entries'))
+    archives = [(year, sorted((m for y, m in entries.by_month if y == year), reverse=True))
+            for year in entries.years]
+
+    key = manifest.key('blog/index.html', archives, 
+            [(e.id, e.title, e.publication_date) for e in recent])
+    constance.generate_page(os.path.join(dir, 'index.html'), key, xslt, 
+            template_loader, 'blog/index.html', items=recent, archives=archives, config=config)
+    for year, months in archives:
+        year_entries = entries.by_year[year]
+        key = manifest.key('blog/archive.html', year, months, 
+                [(e.id, e.title, e.publication_date) for e in year_entries])
+        constance.generate_page(os.path.join(dir, 'archive', '%04d.html' % year), key, 
+                xslt, template_loader, 'blog/archive.html', year=year, month=None, 
+                months=months, items=year_entries, config=config)
+        for month in months:
+            month_entries = entries.by_month[(year, month)]
+            key = manifest.key('blog/archive.html', year, month, 
+                    [(e.id, e.title, e.publication_date) for e in month_entries])
+            constance.generate_page(os.path.join(dir, 'archive', '%04d-%02d.html' % (year, month)), 
+                    key, xslt, template_loader, 'blog/archive.html', year=year, month=month, 
+                    months=[], items=month_entries, config=config)
 
     # feed
-    rendered = template_loader.load('index.atom').generate(items=entries,
-            config=config).render('xml')
-    constance.output(os.path.join(dir, 'index.atom'), rendered)
+    feeds.generate(template_loader, 'blog/index.atom', os.path.join(dir, 'index.atom'), 
+            entries.by_date, config, 'blog')
 
     return entries
@@ -0,0 +1,51 @@
+# vim:fileencoding=utf-8
+
+# On-disk cache of expensive intermediate results which persists across builds.
+# Values are pickled, one file per key, under the cache directory. Keys must
+# identify the value's inputs completely (typically a content hash), so
+# entries are never invalidated, only superseded. Callers which know an
+# entry has been superseded for good may remove it.
+
+import os
+import cPickle
+import tempfile
+
+# set from the cache_dir config option; None disables the cache
+directory = None
+
+def _path(namespace, key):
+    return os.path.join(directory, namespace, key[:2], key)
+
+def get(namespace, key, default=None):
+    if directory is None:
+        return default
+    try:
+        with open(_path(namespace, key), 'rb') as fp:
+            return cPickle.load(fp)
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        return default
+
+def put(namespace, key, value):
+    if directory is None:
+        return
+    path = _path(namespace, key)
+    dir = os.path.dirname(path)
+    if not os.path.isdir(dir):
+        try:
+            os.makedirs(dir)
+        except OSError:
+            # another worker process got there first
+            if not os.path.isdir(dir):
+                raise
+    fd, tmp_path = tempfile.mkstemp(dir=dir)
+    with os.fdopen(fd, 'wb') as fp:
+        cPickle.dump(value, fp, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, path)
+
+def remove(namespace, key):
+    if directory is None:
+        return
+    try:
+        os.remove(_path(namespace, key))
+    except OSError:
+        pass
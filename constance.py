@@ -9,66 +9,578 @@ from ConfigParser import SafeConfigParser
 import re
 import datetime
 import time
+import errno
+import hashlib
+import tempfile
 import urllib
 import codecs
 import optparse
+import traceback
+import multiprocessing
+from itertools import izip
+import genshi
 import genshi.template
+from genshi.core import START, END, TEXT, COMMENT, PI, START_NS
+from genshi.output import WhitespaceFilter, XHTMLSerializer
 import lxml.etree
 
+import cache
+import entryset
+import loader
+import manifest
+import stats
 import blog
 import reading
 import tags
 import homepage
+import precompress
 
-def output(filename, content):
+def render(template_loader, template_name, method, **kwargs):
+    with stats.timed('template load'):
+        template = template_loader.load(template_name)
+    with stats.timed('template render'):
+        return template.generate(**kwargs).render(method)
+
+def render_to(out, template_loader, template_name, method, **kwargs):
+    """
+    Like render, but writes the output to the file object out as it is 
+    serialized.
+    """
+    with stats.timed('template load'):
+        template = template_loader.load(template_name)
+    with stats.timed('template render'):
+        template.generate(**kwargs).render(method, out=out)
+
+def render_fragment(template_loader, template_name, key, **kwargs):
+    """
+    Renders a template as XML for splicing into other templates, reusing the 
+    copy cached on disk under key (from manifest.fragment_key) if there is 
+    one.
+    """
+    fragment = cache.get('fragment', key)
+    if fragment is None:
+        fragment = genshi.Markup(render(template_loader, template_name, 'xml', 
+                **kwargs).decode('utf8'))
+        cache.put('fragment', key, fragment)
+    return fragment
+
+def _clark(qname):
+    if qname.namespace:
+        return u'{%s}%s' % (qname.namespace, qname.localname)
+    return unicode(qname.localname)
+
+def _append_text(parent, text):
+    if len(parent):
+        last = parent[-1]
+        last.tail = (last.tail or u'') + text
+    else:
+        parent.text = (parent.text or u'') + text
+
+def _append_markup(parent, markup):
+    # Markup (rendered Markdown, fragments) is serialized XML, in the 
+    # namespaces in scope where it is inserted
+    declarations = u''.join(prefix and u' xmlns:%s="%s"' % (prefix, uri) or 
+            u' xmlns="%s"' % uri for prefix, uri in parent.nsmap.iteritems())
+    wrapper = lxml.etree.fromstring((u'<fragment%s>%s</fragment>' % 
+            (declarations, markup)).encode('utf8'))
+    if wrapper.text:
+        _append_text(parent, wrapper.text)
+    for child in list(wrapper):
+        parent.append(child)
+
+def build_tree(stream):
+    """
+    Builds an lxml tree from a Genshi event stream, with the same whitespace 
+    handling as rendering it as XHTML, without serializing and reparsing it.
+    """
+    root = None
+    open_elements = []
+    declared = {}
+    whitespace = WhitespaceFilter(XHTMLSerializer._PRESERVE_SPACE)
+    for kind, data, pos in whitespace(stream):
+        if kind is START:
+            tag, attrs = data
+            if open_elements:
+                element = lxml.etree.SubElement(open_elements[-1], _clark(tag), 
+                        nsmap=declared or None)
+            else:
+                element = root = lxml.etree.Element(_clark(tag), nsmap=declared or None)
+            for name, value in attrs:
+                element.set(_clark(name), value)
+            open_elements.append(element)
+            declared = {}
+        elif kind is END:
+            open_elements.pop()
+        elif kind is START_NS:
+            prefix, uri = data
+            declared[prefix or None] = uri
+        elif not open_elements:
+            continue # whitespace around the root element
+        elif kind is TEXT:
+            # the whitespace filter marks up all text, escaping it as needed
+            if u'<' in data or u'&' in data:
+                _append_markup(open_elements[-1], data)
+            elif data:
+                _append_text(open_elements[-1], unicode(data))
+        elif kind is COMMENT:
+            open_elements[-1].append(lxml.etree.Comment(data))
+        elif kind is PI:
+            open_elements[-1].append(lxml.etree.PI(*data))
+    return root
+
+def render_tree(template_loader, template_name, **kwargs):
+    with stats.timed('template load'):
+        template = template_loader.load(template_name)
+    with stats.timed('template render'):
+        return build_tree(template.generate(**kwargs))
+
+def transform(xslt, doc, out):
+    """
+    Transforms doc with the stylesheet, writing the result to the file 
+    object out.
+    """
+    with stats.timed('xslt'):
+        result = xslt(doc)
+        try:
+            result.write_output(out)
+        except (AttributeError, LookupError):
+            # lxml < 4.0 has no write_output, and it fails (before writing 
+            # anything) if the stylesheet's xsl:output gives no encoding
+            out.write(str(result))
+
+def generate_page(filename, key, xslt, template_loader, template_name, **kwargs):
+    """
+    Renders an HTML page and transforms it with the stylesheet, unless the 
+    manifest shows it is already up to date.
+    """
+    if manifest.fresh(filename, key):
+        return
+    doc = render_tree(template_loader, template_name, **kwargs)
+    output_with(filename, lambda out: transform(xslt, doc, out), key)
+
+def output(filename, content, key=None):
     assert isinstance(content, str)
-    if os.path.exists(filename):
-        existing = open(filename, 'r').read()
-        if content == existing:
-            print 'Skipped %s' % filename
-            return
-    open(filename, 'w').write(content)
+    def write(out):
+        with stats.timed('output write'):
+            out.write(content)
+    output_with(filename, write, key)
+
+def output_with(filename, write, key=None):
+    """
+    Like output, but the content is produced by calling write with a file 
+    object, so that it is written as it is generated rather than being held 
+    in memory in one piece.
+    """
+    finish_output(filename, write_temporary(filename, write), key)
+
+# files are created with the same permissions as open() would give them
+_umask = os.umask(0)
+os.umask(_umask)
+
+class _HashingFile(object):
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.hash = hashlib.sha1()
+
+    def write(self, data):
+        self.hash.update(data)
+        self.fp.write(data)
+
+def write_temporary(filename, write):
+    """
+    Writes the new content for filename (as for output_with) to a temporary 
+    file alongside it. Returns the temporary file's name and the content's 
+    digest, for finish_output.
+    """
+    dir = os.path.dirname(filename)
+    if dir and not os.path.isdir(dir):
+        try:
+            os.makedirs(dir)
+        except OSError, e:
+            # another worker process may have just created it
+            if e.errno != errno.EEXIST:
+                raise
+    fd, temporary = tempfile.mkstemp(dir=dir or '.', 
+            prefix='.%s.' % os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            out = _HashingFile(fp)
+            write(out)
+        os.chmod(temporary, 0666 & ~_umask)
+    except:
+        os.remove(temporary)
+        raise
+    return temporary, out.hash.hexdigest()
+
+# write_temporary's file names: "." + the output's name + "." + 6 random 
+# characters from tempfile.mkstemp
+TEMPORARY_PATT = re.compile(r'^\.(.+)\.[A-Za-z0-9_]{6}$')
+
+def remove_temporaries(filenames):
+    """
+    Removes any temporary files written for the given output filenames which 
+    were never swapped in, such as those written by worker processes whose 
+    results were abandoned.
+    """
+    names_by_dir = {}
+    for filename in filenames:
+        dir, name = os.path.split(filename)
+        names_by_dir.setdefault(dir, set()).add(name)
+    for dir, names in names_by_dir.iteritems():
+        try:
+            listing = os.listdir(dir or '.')
+        except OSError:
+            continue
+        for name in listing:
+            match = TEMPORARY_PATT.match(name)
+            if match and match.group(1) in names:
+                os.remove(os.path.join(dir, name))
+
+class WorkerError(Exception):
+    """
+    An exception raised in a worker process, re-raised with its formatted 
+    traceback, since the original exception might not survive pickling 
+    (lxml's don't).
+    """
+    pass
+
+def _start_worker(initializer, initargs):
+    # forget what the parent recorded before forking, so it isn't merged twice
+    stats.reset()
+    if initializer is not None:
+        initializer(*initargs)
+
+class _InWorker(object):
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, args):
+        try:
+            result = self.function(*args)
+        except Exception:
+            raise WorkerError(traceback.format_exc())
+        return result, stats.take()
+
+def map_in_workers(function, work, jobs, collect, outputs=(), 
+        initializer=None, initargs=()):
+    """
+    Calls function(*args) for each args in work, in jobs worker processes 
+    if there is more than one (and more than one item of work), and passes 
+    args and the result to collect in the parent, in order. Stats recorded 
+    by the workers are merged. If anything fails, the workers are stopped 
+    and any temporary files they wrote for the given output filenames which 
+    were never collected are removed.
+    """
+    if jobs <= 1 or len(work) <= 1:
+        for args in work:
+            collect(args, function(*args))
+        return
+    pool = multiprocessing.Pool(jobs, _start_worker, (initializer, initargs))
+    try:
+        results = pool.imap(_InWorker(function), work, 
+                chunksize=max(1, len(work) // (jobs * 4)))
+        for args, (result, taken) in izip(work, results):
+            stats.merge(taken)
+            collect(args, result)
+    except:
+        pool.terminate()
+        pool.join()
+        remove_temporaries(outputs)
+        raise
+    pool.close()
+    pool.join()
+
+def _same_content(filename, other, block_size=65536):
+    if os.path.getsize(filename) != os.path.getsize(other):
+        return False
+    with open(filename, 'rb') as a:
+        with open(other, 'rb') as b:
+            while True:
+                block = a.read(block_size)
+                if block != b.read(block_size):
+                    return False
+                if not block:
+                    return True
+
+def finish_output(filename, (temporary, digest), key=None):
+    """
+    Replaces filename with the temporary file written by write_temporary, 
+    unless the manifest shows that filename already has the same content. 
+    The replacement is atomic, so a half-written file is never visible.
+    """
+    if key is not None:
+        manifest.record(filename, key)
+    st = os.stat(temporary)
+    same = manifest.content_unchanged(filename, digest)
+    if same is None and os.path.exists(filename):
+        # not recorded by the previous build, so compare the old file
+        with stats.timed('output compare'):
+            same = _same_content(filename, temporary)
+    if same:
+        st = os.stat(filename)
+        os.remove(temporary)
+        manifest.record_content(filename, digest, st)
+        stats.count('bytes skipped', st.st_size)
+        print 'Skipped %s' % filename
+        return
+    manifest.replace(temporary, filename)
+    manifest.record_content(filename, digest, st)
+    stats.count('bytes written', st.st_size)
     print 'Wrote %s' % filename
 
+CONFIG_DEFAULTS = {
+    'manifest': '.constance-manifest',
+    'cache_dir': '.constance-cache',
+    'feed_entries': '20',
+    'index_entries': '20',
+    'related_entries': '5',
+    'covers_dir': '',
+    'cover_sizes': 'thumbnail:100x150',
+    'firehose_archive': 'true',
+    'fsync': 'false',
+    'precompress': 'gzip',
+}
+
+def remove_stale_outputs():
+    """
+    Removes the outputs of earlier builds which this build no longer 
+    produces (such as archive pages for a month with no entries left), with
+    their precompressed copies, and any directories left empty.
+    """
+    for filename in manifest.stale():
+        for path in [filename] + [filename + extension 
+                for extension, compressor in precompress.ENCODINGS.itervalues()]:
+            if os.path.exists(path):
+                os.remove(path)
+                stats.count('outputs removed')
+                print 'Removed %s' % path
+        if os.path.dirname(filename):
+            try:
+                os.removedirs(os.path.dirname(filename))
+            except OSError:
+                pass
+
+STAGES = ('blog', 'reading', 'tags', 'html.in', 'homepage')
+
+# how long to wait for a burst of filesystem changes to finish in --watch mode
+WATCH_SETTLE_MS = 200
+
+package_dir = os.path.realpath(os.path.dirname(__file__))
+
+def build(config, options, xslt, stages=STAGES, results=None):
+    """
+    Runs the given generator stages. Entry sets produced by the blog and 
+    reading stages are stored in results, so that a later partial build (in 
+    --watch mode) can feed them to the tags and homepage stages without 
+    regenerating them.
+    """
+    if results is None:
+        results = {}
+    stats.reset()
+    cache.directory = config.get('global', 'cache_dir')
+    manifest.load(config.get('global', 'manifest'), config, 
+            force=options.force, partial=(stages != STAGES))
+
+    try:
+        if 'blog' in stages:
+            if config.getboolean('blog', 'enabled'):
+                with stats.generating('blog'):
+                    results['blog'] = blog.generate('blog', xslt, config, jobs=options.jobs)
+            else:
+                results['blog'] = entryset.EntrySet([])
+
+        if 'reading' in stages:
+            if config.getboolean('reading', 'enabled'):
+                with stats.generating('reading'):
+                    results['reading'] = reading.generate('reading_log.yaml', xslt, config, 
+                            jobs=options.jobs)
+            else:
+                results['reading'] = entryset.EntrySet([])
+
+        if 'tags' in stages and config.getboolean('tags', 'enabled'):
+            with stats.generating('tags'):
+                results['tags'] = tags.generate('tags', xslt, results['blog'], config)
+
+        if 'html.in' in stages:
+            with stats.generating('html.in'):
+                for filename in os.listdir('.'):
+                    if filename.endswith('.html.in'):
+                        key = manifest.key('html.in', manifest.file_hash(filename))
+                        if manifest.fresh(filename[:-3], key):
+                            continue
+                        with stats.timed('parse'):
+                            doc = lxml.etree.parse(filename)
+                        output_with(filename[:-3], 
+                                lambda out: transform(xslt, doc, out), key)
+
+        if 'homepage' in stages and config.getboolean('homepage', 'enabled'):
+            with stats.generating('homepage'):
+                homepage.generate('', xslt, results['blog'], 
+                        results['reading'], config)
+
+        with stats.generating('precompress'):
+            precompress.generate(config, jobs=options.jobs)
+
+        if stages == STAGES:
+            remove_stale_outputs()
+
+        manifest.save()
+    except:
+        manifest.discard_pending()
+        raise
+    if options.stats:
+        stats.print_report()
+    if options.stats_json:
+        stats.write_json(options.stats_json)
+    return results
+
+def affected_stages(config, paths):
+    root_dir = os.path.realpath('.')
+    blog_dir = os.path.realpath('blog')
+    reading_log = os.path.realpath('reading_log.yaml')
+    covers_dir = config.get('reading', 'covers_dir')
+    covers_dir = covers_dir and os.path.realpath(covers_dir)
+    xslt_filename = os.path.realpath(config.get('global', 'xslt'))
+    template_dir = os.path.join(package_dir, 'templates')
+    stages = set()
+    for path in paths:
+        path = os.path.realpath(path)
+        dir, name = os.path.split(path)
+        if name.startswith('.'):
+            continue
+        if path == xslt_filename or path.startswith(template_dir + os.sep):
+            return STAGES
+        if dir == blog_dir and name.endswith('.txt'):
+            stages.update(['blog', 'tags', 'homepage'])
+        elif path == reading_log:
+            stages.update(['reading', 'homepage'])
+        elif dir == covers_dir:
+            stages.add('reading')
+        elif dir == root_dir and name.endswith('.html.in'):
+            stages.add('html.in')
+    return tuple(stage for stage in STAGES if stage in stages)
+
+def _inotify_changes(pyinotify, dirs, recursive_dirs):
+    watch_manager = pyinotify.WatchManager()
+    mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | 
+            pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE)
+    for dir in dirs:
+        watch_manager.add_watch(dir, mask)
+    for dir in recursive_dirs:
+        watch_manager.add_watch(dir, mask, rec=True, auto_add=True)
+    changed = set()
+    notifier = pyinotify.Notifier(watch_manager, 
+            lambda event: changed.add(event.pathname))
+    while True:
+        notifier.check_events(None)
+        # keep reading until the burst of changes has settled
+        while True:
+            notifier.read_events()
+            notifier.process_events()
+            if not notifier.check_events(WATCH_SETTLE_MS):
+                break
+        yield set(changed)
+        changed.clear()
+
+def _polled_changes(dirs, recursive_dirs):
+    def snapshot():
+        mtimes = {}
+        def record(path):
+            try:
+                mtimes[path] = os.path.getmtime(path)
+            except OSError:
+                # removed since the directory was listed; its absence from 
+                # this snapshot counts as the change
+                pass
+        for dir in dirs:
+            for name in os.listdir(dir):
+                record(os.path.join(dir, name))
+        for dir in recursive_dirs:
+            for dirpath, dirnames, filenames in os.walk(dir):
+                for name in filenames:
+                    record(os.path.join(dirpath, name))
+        return mtimes
+    before = snapshot()
+    while True:
+        time.sleep(WATCH_SETTLE_MS / 1000.0)
+        after = snapshot()
+        changed = set(path for path in set(before) | set(after) 
+                if before.get(path) != after.get(path))
+        before = after
+        if changed:
+            yield changed
+
+def watch(config, options):
+    """
+    Builds once, then stays resident and rebuilds whatever is affected by 
+    each change to the sources. Parsed entries, loaded templates and the 
+    compiled stylesheet stay in memory between builds.
+    """
+    loader.template_loader.auto_reload = True
+    xslt_filename = os.path.realpath(config.get('global', 'xslt'))
+    xslt = lxml.etree.XSLT(lxml.etree.parse(xslt_filename))
+    results = build(config, options, xslt)
+    options.force = False
+
+    dirs = set(os.path.realpath(dir) for dir in 
+            ['.', 'blog', os.path.dirname(xslt_filename), 
+            config.get('reading', 'covers_dir')] if os.path.isdir(dir))
+    recursive_dirs = [os.path.join(package_dir, 'templates')]
+    try:
+        import pyinotify
+    except ImportError:
+        print 'pyinotify not available, polling for changes instead'
+        changes = _polled_changes(dirs, recursive_dirs)
+    else:
+        changes = _inotify_changes(pyinotify, dirs, recursive_dirs)
+
+    print 'Watching for changes'
+    for paths in changes:
+        stages = affected_stages(config, paths)
+        if not stages:
+            continue
+        try:
+            if xslt_filename in set(os.path.realpath(path) for path in paths):
+                xslt = lxml.etree.XSLT(lxml.etree.parse(xslt_filename))
+            build(config, options, xslt, stages, results)
+        except Exception:
+            traceback.print_exc()
+
 def main():
     # set up argument parser
     parser = optparse.OptionParser()
     parser.add_option('--config', metavar='FILENAME')
-    parser.set_defaults(config='~/.constance.conf')
+    parser.add_option('--force', action='store_true',
+            help='ignore the build manifest and regenerate every page')
+    parser.add_option('-j', '--jobs', type='int', metavar='N',
+            help='render blog entries, resize covers and compress pages in N worker processes')
+    parser.add_option('--watch', action='store_true',
+            help='stay running and rebuild whenever the sources change')
+    parser.add_option('--stats', action='store_true',
+            help='report time spent and call counts for each build stage')
+    parser.add_option('--stats-json', metavar='FILENAME',
+            help='also write the --stats report to FILENAME as JSON')
+    parser.set_defaults(config='~/.constance.conf', force=False, jobs=1, 
+            watch=False, stats=False, stats_json=None)
     options, args = parser.parse_args()
+    stats.enabled = options.stats or bool(options.stats_json)
 
     # populate config from default location (which would have been
     # overidden by --config above, if given)
-    config = SafeConfigParser()
+    config = SafeConfigParser(CONFIG_DEFAULTS)
     with codecs.open(os.path.expanduser(options.config), 'r', 'utf8') as fp:
         config.readfp(fp)
 
     if config.get('global', 'root'):
         os.chdir(config.get('global', 'root'))
 
-    xslt = lxml.etree.XSLT(lxml.etree.parse(config.get('global', 'xslt')))
-
-    if config.getboolean('blog', 'enabled'):
-        blog_entries = blog.generate('blog', xslt, config)
-    else:
-        blog_entries = []
-
-    if config.getboolean('reading', 'enabled'):
-        reading_entries = reading.generate('reading_log.yaml', xslt, config)
+    if options.watch:
+        watch(config, options)
     else:
-        reading_entries = []
-
-    if config.getboolean('tags', 'enabled'):
-        tags.generate('tags', xslt, blog_entries, config)
-
-    for filename in os.listdir('.'):
-        if filename.endswith('.html.in'):
-            transformed = str(xslt(lxml.etree.parse(filename)))
-            output(filename[:-3], transformed)
-
-    if config.getboolean('homepage', 'enabled'):
-        homepage.generate('', xslt, blog_entries, 
-                reading_entries, config)
+        xslt = lxml.etree.XSLT(lxml.etree.parse(config.get('global', 'xslt')))
+        build(config, options, xslt)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,154 @@
+# vim:fileencoding=utf-8
+
+# Thumbnails of book covers for the reading log, resized from a directory of
+# source images named by ISBN (covers_dir in the [reading] section). Each
+# thumbnail is cached on disk by the hash of its source image and its size
+# and format, so a cover is only ever resized once. Requires PIL (or Pillow).
+
+import os
+import hashlib
+from cStringIO import StringIO
+
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+import constance
+import cache
+import manifest
+import stats
+
+SOURCE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+# (PIL format, file extension, save options)
+FORMATS = [('JPEG', '.jpg', (('optimize', True), ('quality', 85))),
+           ('WEBP', '.webp', (('quality', 80),))]
+PIL_VERSION = Image is not None and \
+        (getattr(Image, '__version__', None) or getattr(Image, 'VERSION', None))
+# changed whenever resize produces different thumbnails, so that cached ones
+# are not reused
+RESIZE_VERSION = '2'
+# what transparent areas of a cover are filled in with
+BACKGROUND = (255, 255, 255)
+
+def available_formats():
+    Image.init()
+    return [format for format in FORMATS if format[0] in Image.SAVE]
+
+def parse_sizes(value):
+    """
+    Parses the cover_sizes option: comma-separated NAME:WIDTHxHEIGHT.
+    """
+    sizes = []
+    for size in value.split(','):
+        if size.strip():
+            name, dimensions = size.strip().split(':')
+            width, height = dimensions.split('x')
+            sizes.append((name.strip(), int(width), int(height)))
+    return sizes
+
+def source_hash(path, previous_hashes, hashes):
+    """
+    Returns the hash of the source image, reusing the hash recorded by the
+    previous build if the file has not been modified since.
+    """
+    st = os.stat(path)
+    previous = previous_hashes.get(path)
+    if previous is not None and previous[:2] == (st.st_mtime, st.st_size):
+        hash = previous[2]
+    else:
+        hash = manifest.file_hash(path)
+    hashes[path] = (st.st_mtime, st.st_size, hash)
+    return hash
+
+def flatten(image):
+    """
+    Returns image in RGB mode, with any transparent areas filled in with 
+    BACKGROUND (convert('RGB') alone would turn them black).
+    """
+    if image.mode in ('RGBA', 'LA', 'PA') or \
+            (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, BACKGROUND)
+        background.paste(image, mask=image.split()[3])
+        return background
+    if image.mode != 'RGB':
+        return image.convert('RGB')
+    return image
+
+def resize(path, variants):
+    """
+    Returns the thumbnail data for each (width, height, format) in variants,
+    opening the source image only once.
+    """
+    with stats.timed('cover resize'):
+        source = flatten(Image.open(path))
+        results = []
+        for width, height, (format, extension, options) in variants:
+            image = source.copy()
+            image.thumbnail((width, height), Image.ANTIALIAS)
+            buffer = StringIO()
+            image.save(buffer, format, **dict(options))
+            results.append(buffer.getvalue())
+        return results
+
+def _resize_variants(path, to_resize):
+    return resize(path, [variant for filename, key, cache_key, variant in to_resize])
+
+def generate(dir, entries, config, jobs=1):
+    """
+    Writes each size of thumbnail, in each format PIL can save, for each
+    entry with a source cover to covers/isbn/ISBN/SIZE.EXT, so that
+    /covers/isbn/ISBN/thumbnail resolves by content negotiation.
+    """
+    source_dir = config.get('reading', 'covers_dir')
+    if not source_dir or Image is None:
+        return []
+    sources = {}
+    for filename in os.listdir(source_dir):
+        base, extension = os.path.splitext(filename)
+        if extension.lower() in SOURCE_EXTENSIONS:
+            sources[base] = os.path.join(source_dir, filename)
+    sizes = parse_sizes(config.get('reading', 'cover_sizes'))
+    formats = available_formats()
+
+    hashes = {}
+    previous_hashes = manifest.previous_state.get('covers', {})
+    filenames = []
+    missing = [] # (path, [(filename, key, cache key, variant)])
+    for entry in entries:
+        if entry.isbn is None:
+            continue
+        isbn = unicode(entry.isbn).encode('utf8')
+        path = sources.get(isbn)
+        if path is None:
+            continue
+        hash = source_hash(path, previous_hashes, hashes)
+        to_resize = []
+        for name, width, height in sizes:
+            for format in formats:
+                filename = os.path.join(dir, 'covers', 'isbn', isbn, name + format[1])
+                filenames.append(filename)
+                key = manifest.key('cover', hash, width, height, format)
+                if manifest.fresh(filename, key):
+                    continue
+                cache_key = hashlib.sha1(repr((hash, width, height, format,
+                        PIL_VERSION, RESIZE_VERSION))).hexdigest()
+                data = cache.get('cover', cache_key)
+                if data is None:
+                    to_resize.append((filename, key, cache_key, (width, height, format)))
+                else:
+                    constance.output(filename, data, key)
+        if to_resize:
+            missing.append((path, to_resize))
+    manifest.state['covers'] = hashes
+
+    def collect((path, to_resize), resized):
+        for (filename, key, cache_key, variant), data in zip(to_resize, resized):
+            cache.put('cover', cache_key, data)
+            constance.output(filename, data, key)
+    constance.map_in_workers(_resize_variants, missing, jobs, collect)
+    return filenames
@@ -0,0 +1,96 @@
+# vim:fileencoding=utf-8
+
+# Base class for the blog and reading log entry sets: the entries in source
+# order, plus views of them newest first (by publication date) which are
+# computed once per build and shared by every page and feed, so templates
+# never need to sort.
+
+from itertools import groupby
+
+def _insert_descending(items, item, key):
+    # bisect.insort for a list in descending order of key
+    lo, hi = 0, len(items)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key(items[mid]) < key(item):
+            hi = mid
+        else:
+            lo = mid + 1
+    items.insert(lo, item)
+
+class EntrySet(object):
+
+    def __init__(self, entries):
+        self.entries = list(entries)
+        self._by_date = None
+        self._by_year = None
+        self._by_month = None
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def by_date(self):
+        """
+        The entries, newest first.
+        """
+        if self._by_date is None:
+            self._by_date = sorted(self.entries,
+                    key=lambda e: e.publication_date, reverse=True)
+        return self._by_date
+
+    def reuse_order(self, previous):
+        """
+        Computes by_date from the previous build's set, for when only a few
+        of its entries (identified by object) have been added, removed or
+        replaced since: those are inserted in place rather than sorting
+        everything again.
+        """
+        # equal dates are in source order, as the stable sort leaves them
+        positions = dict((id(entry), i) for i, entry in enumerate(self.entries))
+        key = lambda e: (e.publication_date, -positions[id(e)])
+        by_date = [entry for entry in previous.by_date if id(entry) in positions]
+        kept = set(id(entry) for entry in by_date)
+        for entry in self.entries:
+            if id(entry) not in kept:
+                _insert_descending(by_date, entry, key)
+        self._by_date = by_date
+
+    def recent(self, count):
+        """
+        The count newest entries, or all of them if count is 0.
+        """
+        if count > 0:
+            return self.by_date[:count]
+        return self.by_date
+
+    @property
+    def by_year(self):
+        """
+        Dict of year to that year's entries, newest first.
+        """
+        if self._by_year is None:
+            self._by_year = dict((year, list(entries)) for year, entries in
+                    groupby(self.by_date, lambda e: e.publication_date.year))
+        return self._by_year
+
+    @property
+    def by_month(self):
+        """
+        Dict of (year, month) to that month's entries, newest first.
+        """
+        if self._by_month is None:
+            self._by_month = dict((month, list(entries)) for month, entries in
+                    groupby(self.by_date, lambda e: (e.publication_date.year,
+                        e.publication_date.month)))
+        return self._by_month
+
+    @property
+    def years(self):
+        """
+        The years which have entries, newest first.
+        """
+        return sorted(self.by_year, reverse=True)
@@ -0,0 +1,101 @@
+# vim:fileencoding=utf-8
+
+# Atom feeds capped to the most recent entries, with the rest of the history
+# in RFC 5005 archive documents. Archive documents hold fixed, complete pages
+# of entries counted from the oldest, so once a page is full its contents
+# (and hence its output) only change if one of its entries is edited.
+
+import os
+import heapq
+import urllib
+
+import constance
+import manifest
+
+class FeedPage(object):
+
+    def __init__(self, url, current_url, prev_archive_url=None,
+            next_archive_url=None, is_archive=False):
+        self.url = url
+        self.current_url = current_url
+        self.prev_archive_url = prev_archive_url
+        self.next_archive_url = next_archive_url
+        self.is_archive = is_archive
+
+class _NewestFirst(object):
+    # orders items newest first, for heapq.merge (which has no key argument)
+
+    __slots__ = ['item']
+
+    def __init__(self, item):
+        self.item = item
+
+    def __lt__(self, other):
+        return self.item.publication_date > other.item.publication_date
+
+def merge_newest_first(*iterables):
+    """
+    Lazily merges iterables of items, each already ordered newest first, 
+    into a single iterable ordered newest first.
+    """
+    wrapped = [(_NewestFirst(item) for item in iterable) for iterable in iterables]
+    return (w.item for w in heapq.merge(*wrapped))
+
+def archive_pages(items, size):
+    """
+    Splits items, which must be oldest first, into complete pages of the 
+    given size. The remaining newest items (fewer than size) are not 
+    archived yet.
+    """
+    items = list(items)
+    return [items[i:i + size] for i in xrange(0, len(items) - size + 1, size)]
+
+def archive_filename(filename, number):
+    base, ext = os.path.splitext(filename)
+    return '%s-archive-%d%s' % (base, number, ext)
+
+def generate(template_loader, template_name, filename, items, config, section, 
+        archive=True, **kwargs):
+    """
+    Writes the feed to filename (which is also its URL relative to 
+    url_base), holding the feed_entries most recent items, followed by its 
+    archive documents unless archive is False. Items must be newest first, 
+    and are passed to the template in that order. Extra keyword arguments 
+    are passed to the template. Returns the filenames of the documents.
+    """
+    url_base = config.get('global', 'url_base')
+    size = config.getint(section, 'feed_entries')
+    items = list(items)
+    if size > 0:
+        pages = archive and archive_pages(reversed(items), size) or []
+        latest = items[:size]
+    else:
+        pages = []
+        latest = items
+
+    filenames = [archive_filename(filename, i + 1) for i in xrange(len(pages))]
+    urls = [url_base + urllib.quote(f) for f in filenames]
+    for i, page_items in enumerate(pages):
+        page = FeedPage(urls[i], url_base + urllib.quote(filename), 
+                prev_archive_url=(i > 0 and urls[i - 1] or None), 
+                next_archive_url=(i + 1 < len(pages) and urls[i + 1] or None), 
+                is_archive=True)
+        _generate_page(template_loader, template_name, filenames[i], 
+                page_items[::-1], page, config, kwargs)
+
+    page = FeedPage(url_base + urllib.quote(filename), url_base + urllib.quote(filename), 
+            prev_archive_url=(urls and urls[-1] or None))
+    _generate_page(template_loader, template_name, filename, latest, page, config, kwargs)
+    return filenames + [filename]
+
+def _generate_page(template_loader, template_name, filename, items, page, config, kwargs):
+    # blog entries are linked by id, which comes from the file name (reading 
+    # log entries have none, and their guid stands in)
+    key = manifest.key(template_name, sorted(vars(page).items()), sorted(kwargs.items()), 
+            [(getattr(item, 'id', item.guid), item.guid, item.source_hash, 
+                item.modified_date) for item in items])
+    if manifest.fresh(filename, key):
+        return
+    constance.output_with(filename, lambda out: constance.render_to(out, 
+            template_loader, template_name, 'xml', 
+            items=items, page=page, config=config, **kwargs), key)
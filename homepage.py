@@ -2,28 +2,33 @@
 # vim:fileencoding=utf-8
 
 import os
-from itertools import chain
-import genshi.template
+from itertools import islice
 import lxml.etree
 
 import constance
+import feeds
+import manifest
 import viewutils
-
-template_loader = genshi.template.TemplateLoader(
-        os.path.join(os.path.realpath(os.path.dirname(__file__)), 'templates', 'homepage'), 
-        variable_lookup='strict')
+from loader import template_loader
 
 def generate(dir, xslt, blog_entries, reading_entries, config):
     # index
-    template = template_loader.load('index.html')
-    rendered = template.generate(blog_entries=blog_entries, 
-            reading_entries=reading_entries, 
-            config=config).render('xhtml')
-    transformed = str(xslt(lxml.etree.fromstring(rendered)))
-    constance.output(os.path.join(dir, 'index.html'), transformed)
+    filename = os.path.join(dir, 'index.html')
+    recent_blog_entries = blog_entries.recent(4)
+    recent_reading_entries = list(islice((e for e in reading_entries.by_date if e.isbn), 6))
+    key = manifest.key('homepage/index.html', 
+            [(e.id, e.title, e.publication_date, sorted(e.tags)) for e in recent_blog_entries], 
+            [e.source_hash for e in recent_reading_entries])
+    constance.generate_page(filename, key, xslt, template_loader, 'homepage/index.html', 
+            recent_blog_entries=recent_blog_entries, 
+            recent_reading_entries=recent_reading_entries, config=config)
 
-    # firehose
-    rendered = template_loader.load('firehose.atom').generate(
-            items=chain(blog_entries, reading_entries),
-            config=config).render('xml')
-    constance.output(os.path.join(dir, 'firehose.atom'), rendered)
+    # firehose: without archives, only the newest feed_entries of the merged 
+    # sets are ever looked at
+    size = config.getint('homepage', 'feed_entries')
+    archive = config.getboolean('homepage', 'firehose_archive')
+    items = feeds.merge_newest_first(blog_entries.by_date, reading_entries.by_date)
+    if not archive and size > 0:
+        items = islice(items, size)
+    feeds.generate(template_loader, 'homepage/firehose.atom', os.path.join(dir, 'firehose.atom'), 
+            items, config, 'homepage', archive=archive)
@@ -58,7 +58,7 @@ try:
 except ImportError:
     from md5 import md5
 import optparse
-from random import random
+from random import Random
 import codecs
 
 
@@ -1477,7 +1477,10 @@ class Markdown(object):
         #
         #  Based on a filter by Matthew Wickline, posted to the BBEdit-Talk
         #  mailing list: <http://tinyurl.com/yu7ue>
-        chars = [_xml_encode_email_char_at_random(ch)
+        # Seeded by the address, so that each address is always encoded
+        # the same way.
+        random = Random(int(md5(addr.encode("utf-8")).hexdigest(), 16)).random
+        chars = [_xml_encode_email_char_at_random(ch, random)
                  for ch in "mailto:" + addr]
         # Strip the mailto: from the visible part.
         addr = '<a href="%s">%s</a>' \
@@ -1709,7 +1712,7 @@ def _hr_tag_re_from_tab_width(tab_width):
 _hr_tag_re_from_tab_width = _memoized(_hr_tag_re_from_tab_width)
 
 
-def _xml_encode_email_char_at_random(ch):
+def _xml_encode_email_char_at_random(ch, random):
     r = random()
     # Roughly 10% raw, 45% hex, 45% dec.
     # '@' *must* be encoded. I [John Gruber] insist.
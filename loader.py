@@ -0,0 +1,88 @@
+# vim:fileencoding=utf-8
+
+# The Genshi template loader shared by every generator. Compiled templates
+# are kept in the on-disk cache, keyed by the template source, so templates
+# are only parsed and compiled when they change rather than once per process.
+
+import os
+import sys
+import types
+import marshal
+import copy_reg
+import hashlib
+from cStringIO import StringIO
+import genshi
+import genshi.template
+from genshi.template.directives import ForDirective, WithDirective
+
+import cache
+import stats
+
+# Genshi can pickle its compiled expressions, but not code objects nested in
+# them (lambdas, generator expressions), nor the assignment functions in
+# py:for and py:with directives, without help.
+
+def _reduce_code(code):
+    return marshal.loads, (marshal.dumps(code),)
+copy_reg.pickle(types.CodeType, _reduce_code)
+
+def _assignment(names):
+    # equivalent to genshi.template.directives._assignment
+    def _assign(data, value, names=names):
+        if type(names) is tuple:
+            for idx in range(len(names)):
+                _assign(data, value[idx], names[idx])
+        else:
+            data[names] = value
+    return _assign
+
+def _assigned_names(assign):
+    return assign.func_defaults[0]
+
+def _make_for(expr, names, filename):
+    directive = ForDirective.__new__(ForDirective)
+    directive.expr = expr
+    directive.assign = _assignment(names)
+    directive.filename = filename
+    return directive
+
+def _reduce_for(directive):
+    return _make_for, (directive.expr, _assigned_names(directive.assign), 
+            directive.filename)
+copy_reg.pickle(ForDirective, _reduce_for)
+
+def _make_with(expr, vars):
+    directive = WithDirective.__new__(WithDirective)
+    directive.expr = expr
+    directive.vars = [([_assignment(names) for names in targets], value)
+            for targets, value in vars]
+    return directive
+
+def _reduce_with(directive):
+    return _make_with, (directive.expr, [([_assigned_names(assign) for assign in targets], value)
+            for targets, value in directive.vars])
+copy_reg.pickle(WithDirective, _reduce_with)
+
+class CachingTemplateLoader(genshi.template.TemplateLoader):
+
+    def _instantiate(self, cls, fileobj, filepath, filename, encoding=None):
+        source = fileobj.read()
+        key = hashlib.sha1(repr((cls.__name__, filepath, encoding, self.variable_lookup,
+                self.allow_exec, genshi.__version__, sys.version)) + source).hexdigest()
+        template = cache.get('template', key)
+        if template is not None:
+            template.loader = self
+            return template
+        with stats.timed('template compile'):
+            template = genshi.template.TemplateLoader._instantiate(self, cls,
+                    StringIO(source), filepath, filename, encoding)
+            template.stream # compiles the template
+        # the loader (with every other loaded template) is not part of it
+        template.loader = None
+        cache.put('template', key, template)
+        template.loader = self
+        return template
+
+template_loader = CachingTemplateLoader(
+        os.path.join(os.path.realpath(os.path.dirname(__file__)), 'templates'),
+        variable_lookup='strict')
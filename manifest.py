@@ -0,0 +1,236 @@
+# vim:fileencoding=utf-8
+
+# Persistent record of the inputs each output file was last generated from,
+# so that pages whose inputs have not changed are not re-rendered at all, and
+# of the content of each output file, so that a re-rendered page which comes
+# out the same is not rewritten (without reading the old file back).
+
+import os
+import cPickle
+import hashlib
+
+import stats
+
+package_dir = os.path.realpath(os.path.dirname(__file__))
+
+filename = None
+code_fingerprint = ''
+fingerprint = ''
+previous = {}
+current = {}
+# output filename -> (sha1 of content, size, mtime)
+previous_contents = {}
+contents = {}
+# With the fsync option, (temporary filename, output filename) for each file 
+# written by this build, to be synced to disk and renamed into place together 
+# when the manifest is saved. Otherwise None.
+pending = None
+# anything else a generator wants to remember between builds, by name
+previous_state = {}
+state = {}
+
+def _hash_files(h, paths):
+    for path in sorted(paths):
+        h.update(path)
+        h.update(open(path, 'rb').read())
+
+def compute_code_fingerprint():
+    """
+    Returns a digest of the templates and the code which renders them.
+    """
+    h = hashlib.sha1()
+    sources = []
+    for dirpath, dirnames, filenames in os.walk(os.path.join(package_dir, 'templates')):
+        sources.extend(os.path.join(dirpath, f) for f in filenames)
+    for dir in [package_dir, os.path.join(package_dir, 'lib')]:
+        sources.extend(os.path.join(dir, f) for f in os.listdir(dir) if f.endswith('.py'))
+    _hash_files(h, sources)
+    return h.hexdigest()
+
+def compute_fingerprint(config, code_fingerprint):
+    """
+    Returns a digest of everything that affects every page: templates,
+    the XSLT stylesheet, the config, and the code which renders them.
+    """
+    h = hashlib.sha1(code_fingerprint)
+    _hash_files(h, [config.get('global', 'xslt')])
+    for section in sorted(config.sections()):
+        h.update(repr((section, sorted(config.items(section, raw=True)))))
+    return h.hexdigest()
+
+def load(manifest_filename, config, force=False, partial=False):
+    """
+    Loads the manifest left by the previous build. For a partial build, 
+    outputs and state of the stages which are not run are carried forward.
+    """
+    global filename, code_fingerprint, fingerprint, previous, previous_state, \
+            previous_contents, pending
+    discard_pending()
+    pending = [] if config.getboolean('global', 'fsync') else None
+    filename = manifest_filename
+    code_fingerprint = compute_code_fingerprint()
+    fingerprint = compute_fingerprint(config, code_fingerprint)
+    previous = {}
+    previous_state = {}
+    previous_contents = {}
+    try:
+        loaded = cPickle.load(open(filename, 'rb'))
+        # content hashes stay valid even when forcing a rebuild
+        previous_contents = loaded.get('contents', {})
+        if not force:
+            previous, previous_state = loaded['outputs'], loaded['state']
+    except (IOError, EOFError, KeyError, TypeError, AttributeError, 
+            cPickle.UnpicklingError):
+        pass
+    current.clear()
+    state.clear()
+    contents.clear()
+    if partial:
+        current.update(previous)
+        state.update(previous_state)
+        contents.update(previous_contents)
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _sync_pending():
+    with stats.timed('output sync'):
+        for temporary, output_filename in pending:
+            _fsync(temporary)
+        for temporary, output_filename in pending:
+            os.rename(temporary, output_filename)
+        for dir in set(os.path.dirname(output_filename) or '.' 
+                for temporary, output_filename in pending):
+            _fsync(dir)
+    del pending[:]
+
+def discard_pending():
+    """
+    Removes the temporary files written with the fsync option by a build 
+    which failed before saving the manifest, instead of renaming them into 
+    place.
+    """
+    if pending:
+        for temporary, output_filename in pending:
+            try:
+                os.remove(temporary)
+            except OSError:
+                # already removed along with a failed worker's results
+                pass
+        del pending[:]
+
+def save():
+    if pending:
+        _sync_pending()
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as fp:
+        cPickle.dump({'outputs': current, 'state': state, 'contents': contents}, 
+                fp, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_filename, filename)
+
+def file_hash(path):
+    return hashlib.sha1(open(path, 'rb').read()).hexdigest()
+
+def key(*parts):
+    """
+    Returns a key identifying the inputs of a page. Parts must have a stable
+    repr (so no sets or dicts).
+    """
+    return hashlib.sha1(fingerprint + repr(parts)).hexdigest()
+
+def fragment_key(template_name, config, options, *parts):
+    """
+    Returns a key for a fragment rendered by template_name (see 
+    constance.render_fragment). Unlike key, it depends only on the given 
+    (section, option) config values, not the whole config or the XSLT, so 
+    that cached fragments survive unrelated config changes.
+    """
+    values = [(section, option, config.get(section, option)) 
+            for section, option in options]
+    return hashlib.sha1(code_fingerprint + 
+            repr((template_name, values, parts))).hexdigest()
+
+def unchanged(output_filename, key):
+    return previous.get(output_filename) == key and os.path.exists(output_filename)
+
+def fresh(output_filename, key):
+    """
+    Returns True if output_filename was last generated from the same key,
+    in which case it is carried forward into the new manifest unchanged.
+    """
+    if unchanged(output_filename, key):
+        current[output_filename] = key
+        _carry_content_forward(output_filename)
+        stats.count('pages up to date')
+        print 'Skipped %s' % output_filename
+        return True
+    return False
+
+def record(output_filename, key):
+    current[output_filename] = key
+
+def replace(temporary, output_filename):
+    """
+    Renames temporary to output_filename, or with the fsync option, arranges 
+    for that to happen once it has been synced to disk.
+    """
+    if pending is not None:
+        pending.append((temporary, output_filename))
+    else:
+        os.rename(temporary, output_filename)
+
+def _carry_content_forward(output_filename):
+    if output_filename in previous_contents:
+        contents[output_filename] = previous_contents[output_filename]
+
+def content_unchanged(output_filename, digest):
+    """
+    Returns True if output_filename was last written with content having the 
+    given digest, and has not been modified since. Returns None if its 
+    content was not recorded.
+    """
+    recorded = contents.get(output_filename) or previous_contents.get(output_filename)
+    if recorded is None:
+        return None
+    try:
+        st = os.stat(output_filename)
+    except OSError:
+        return False
+    return recorded == (digest, st.st_size, st.st_mtime)
+
+def record_content(output_filename, digest, st):
+    """
+    Records that output_filename has content with the given digest, and the 
+    given os.stat result.
+    """
+    contents[output_filename] = (digest, st.st_size, st.st_mtime)
+
+def stale():
+    """
+    Returns the outputs recorded by earlier builds which this build has not
+    produced (only meaningful once every generator has run).
+    """
+    produced = set(current) | set(contents)
+    return sorted(output_filename 
+            for output_filename in set(previous) | set(previous_contents)
+            if output_filename not in produced)
+
+def carry_forward(output_filenames):
+    """
+    Carries the given outputs of the previous build into the new manifest 
+    unchanged, without the caller computing their keys. Returns False, 
+    carrying nothing, if any of them is missing.
+    """
+    for output_filename in output_filenames:
+        if output_filename not in previous or not os.path.exists(output_filename):
+            return False
+    for output_filename in output_filenames:
+        current[output_filename] = previous[output_filename]
+        _carry_content_forward(output_filename)
+        stats.count('pages up to date')
+        print 'Skipped %s' % output_filename
+    return True
@@ -0,0 +1,111 @@
+# vim:fileencoding=utf-8
+
+# Compressed copies of generated pages and feeds (index.html.gz, and
+# index.html.br with the brotli module), written alongside them so that the
+# web server can serve them as they are instead of compressing every
+# response. Which encodings are written is set by the precompress option in
+# the [global] section. A file is only compressed again when the manifest
+# shows its content has changed.
+
+import os
+import gzip
+from cStringIO import StringIO
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import constance
+import manifest
+import stats
+
+COMPRESSIBLE_EXTENSIONS = ('.html', '.atom', '.xml', '.css', '.js', '.txt')
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+def _gzip(data):
+    buffer = StringIO()
+    # no file name or timestamp in the header, so the output is reproducible
+    with gzip.GzipFile('', 'wb', GZIP_LEVEL, buffer, mtime=0) as fp:
+        fp.write(data)
+    return buffer.getvalue()
+
+def _brotli(data):
+    return brotli.compress(data, quality=BROTLI_QUALITY)
+
+# encoding -> (file extension, compressor)
+ENCODINGS = {
+    'gzip': ('.gz', _gzip),
+    'brotli': ('.br', _brotli),
+}
+
+def parse_encodings(value):
+    """
+    Parses the precompress option: comma-separated encodings. Brotli is left
+    out if the module is not installed.
+    """
+    encodings = []
+    for encoding in value.split(','):
+        encoding = encoding.strip().lower()
+        if not encoding:
+            continue
+        if encoding not in ENCODINGS:
+            raise ValueError('Unknown precompress encoding %r' % encoding)
+        if encoding == 'brotli' and brotli is None:
+            continue
+        encodings.append(encoding)
+    return sorted(encodings)
+
+def compress(source, filename, encodings):
+    """
+    Writes a temporary file with each encoding of source (the new content of
+    filename). Returns (temporary file, filename with encoding extension)
+    for each.
+    """
+    with stats.timed('compress'):
+        data = open(source, 'rb').read()
+        written = []
+        for encoding in encodings:
+            extension, compressor = ENCODINGS[encoding]
+            compressed = compressor(data)
+            temporary, digest = constance.write_temporary(filename + extension,
+                    lambda out: out.write(compressed))
+            written.append((temporary, filename + extension))
+        return written
+
+def generate(config, jobs=1):
+    """
+    Compresses each output recorded in the manifest whose content (or the
+    configured encodings) changed since it was last compressed, and removes
+    copies in encodings which are no longer configured.
+    """
+    encodings = tuple(parse_encodings(config.get('global', 'precompress')))
+    previous = manifest.previous_state.get('precompressed', {})
+    # with the fsync option, new content may not have been renamed into place yet
+    sources = dict((filename, temporary)
+            for temporary, filename in manifest.pending or [])
+    precompressed = {}
+    work = []
+    for filename, (digest, size, mtime) in sorted(manifest.contents.iteritems()):
+        if os.path.splitext(filename)[1] not in COMPRESSIBLE_EXTENSIONS:
+            continue
+        previous_digest, previous_encodings = previous.get(filename, (None, ()))
+        for encoding in previous_encodings:
+            if encoding not in encodings and os.path.exists(filename + ENCODINGS[encoding][0]):
+                os.remove(filename + ENCODINGS[encoding][0])
+        if not encodings:
+            continue
+        precompressed[filename] = (digest, encodings)
+        if (previous_digest, previous_encodings) != (digest, encodings):
+            work.append((sources.get(filename, filename), filename, encodings))
+    manifest.state['precompressed'] = precompressed
+
+    def collect(args, written):
+        for temporary, filename in written:
+            stats.count('bytes written', os.path.getsize(temporary))
+            manifest.replace(temporary, filename)
+            print 'Wrote %s' % filename
+    constance.map_in_workers(compress, work, jobs, collect, 
+            outputs=[filename + ENCODINGS[encoding][0] 
+                for source, filename, encodings in work for encoding in encodings])
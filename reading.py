@@ -2,21 +2,32 @@
 # vim:fileencoding=utf-8
 
 import os
-import genshi.template
+import re
+import hashlib
 import yaml
 import lxml.etree
 
 import constance
+import cache
+import covers
+import entryset
+import feeds
+import manifest
+import stats
 import viewutils
+from loader import template_loader
 
-template_loader = genshi.template.TemplateLoader(
-        os.path.join(os.path.realpath(os.path.dirname(__file__)), 'templates', 'reading'), 
-        variable_lookup='strict')
+# the libyaml-based loader is many times faster, where PyYAML was built with it
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+DOCUMENT_START = re.compile(r'^---(?=\s|$)', re.M)
 
 class ReadingLogEntry(object):
 
-    def __init__(self, yaml_dict):
-        self.title = viewutils.mini_markdown(yaml_dict['Title'])
+    def __init__(self, yaml_dict, title=None):
+        self.document = yaml_dict
+        self.source_hash = hashlib.sha1(repr(sorted(yaml_dict.items()))).hexdigest()
+        self.title = title or viewutils.mini_markdown(yaml_dict['Title'])
         self.author = yaml_dict['Author']
         self.publication_date = self.modified_date = self.date = yaml_dict['Date']
         self.url = yaml_dict.get('URL', None)
@@ -24,36 +35,132 @@ class ReadingLogEntry(object):
         self.rating = yaml_dict.get('Rating', None)
         self.tags = frozenset()
         self.guid = yaml_dict['GUID']
+        self._atom = None
+        self._html = None
+
+    def generate_html(self, config):
+        # the page markup for this book, shared by the recent and year pages
+        key = manifest.fragment_key('reading/entry.html', config, (), 
+                self.source_hash)
+        if self._html is None or self._html[0] != key:
+            self._html = (key, constance.render_fragment(template_loader, 
+                    'reading/entry.html', key, item=self, config=config))
+        return self._html[1]
 
     def generate_atom(self, config):
-        return template_loader.load('entry.atom').generate(item=self,
-                config=config)
+        # see BlogEntry.generate_atom
+        key = manifest.fragment_key('reading/entry.atom', config, 
+                viewutils.ATOM_ENTRY_CONFIG, self.source_hash)
+        if self._atom is None or self._atom[0] != key:
+            self._atom = (key, constance.render_fragment(template_loader, 
+                    'reading/entry.atom', key, item=self, config=config))
+        return self._atom[1]
+
+def parse_entries(source):
+    with stats.timed('parse'):
+        return [ReadingLogEntry(d) for d in yaml.load_all(source, Loader=YamlLoader)
+                if d is not None]
 
-class ReadingLogEntrySet(object):
+class ReadingLogEntrySet(entryset.EntrySet):
+    """
+    The reading log is only ever appended to, so the entries parsed from all 
+    but its last document are kept as a snapshot: (length, hash, entries) of 
+    that prefix of the file. Given the snapshot from an earlier version of 
+    the file whose prefix is unchanged, only the documents after it are 
+    parsed. (The last document is always reparsed, since an append might 
+    have continued it.)
+    """
 
-    def __init__(self, filename):
+    def __init__(self, filename, snapshot=None):
         self.filename = filename
-        self.entries = []
-        for d in yaml.load_all(open(self.filename, 'r')):
-            self.entries.append(ReadingLogEntry(d))
+        st = os.stat(filename)
+        self.file_state = (st.st_mtime, st.st_size)
+        source = open(filename, 'rb').read()
+        starts = [m.start() for m in DOCUMENT_START.finditer(source)]
+        last_start = starts and starts[-1] or 0
+
+        head = []
+        offset = 0
+        if snapshot is not None:
+            length, prefix_hash, entries = snapshot
+            if length <= last_start and \
+                    hashlib.sha1(source[:length]).hexdigest() == prefix_hash:
+                head = list(entries)
+                offset = length
+                stats.count('entries from snapshot', len(head))
+        if offset < last_start:
+            head.extend(parse_entries(source[offset:last_start]))
+        self.snapshot = (last_start, hashlib.sha1(source[:last_start]).hexdigest(), head)
+        super(ReadingLogEntrySet, self).__init__(head + parse_entries(source[last_start:]))
+
+# The entry set from the previous build. Only useful when the process stays 
+# resident (--watch).
+_entry_set = None
+
+def _snapshot_key(prefix_hash):
+    return hashlib.sha1(prefix_hash + viewutils.MARKDOWN_SIGNATURE).hexdigest()
 
-    def __iter__(self):
-        return iter(self.entries)
+def load_entries(filename):
+    """
+    Returns the entries in the reading log, starting from the snapshot left 
+    by the previous build (in memory, or else in the cache) where possible.
+    """
+    global _entry_set
+    snapshot = None
+    previous_set = None
+    if _entry_set is not None and _entry_set.filename == filename:
+        st = os.stat(filename)
+        if _entry_set.file_state != (st.st_mtime, st.st_size):
+            snapshot = _entry_set.snapshot
+            previous_set = _entry_set
+            _entry_set = None
+    else:
+        _entry_set = None
+        previous = manifest.previous_state.get('reading')
+        if previous is not None and previous[0] == filename:
+            length, prefix_hash = previous[1:]
+            documents = cache.get('reading-log-documents', _snapshot_key(prefix_hash))
+            if documents is not None:
+                snapshot = (length, prefix_hash, 
+                        [ReadingLogEntry(d, title) for d, title in documents])
+    if _entry_set is None:
+        _entry_set = ReadingLogEntrySet(filename, snapshot)
+        if previous_set is not None:
+            _entry_set.reuse_order(previous_set)
+        length, prefix_hash, entries = _entry_set.snapshot
+        if snapshot is None or snapshot[1] != prefix_hash:
+            cache.put('reading-log-documents', _snapshot_key(prefix_hash), 
+                    [(e.document, e.title) for e in entries])
+            # the previous build's snapshot is superseded by this one
+            previous = manifest.previous_state.get('reading')
+            if previous is not None and previous[2] != prefix_hash:
+                cache.remove('reading-log-documents', _snapshot_key(previous[2]))
+    length, prefix_hash, entries = _entry_set.snapshot
+    manifest.state['reading'] = (filename, length, prefix_hash)
+    return _entry_set
 
-    def __len__(self):
-        return len(self.entries)
+def generate(filename, xslt, config, jobs=1):
+    entries = load_entries(filename)
+    dir = os.path.dirname(filename)
 
-def generate(filename, xslt, config):
-    entries = ReadingLogEntrySet(filename)
+    # recent books, with the rest on a page for each year
+    years = entries.years
+    recent = entries.recent(config.getint('reading', 'index_entries'))
+    key = manifest.key('reading/reading.html', years, [e.source_hash for e in recent])
+    constance.generate_page(os.path.join(dir, 'reading.html'), key, xslt, 
+            template_loader, 'reading/reading.html', items=recent, years=years, config=config)
+    for year in years:
+        year_entries = entries.by_year[year]
+        key = manifest.key('reading/archive.html', year, years, 
+                [e.source_hash for e in year_entries])
+        constance.generate_page(os.path.join(dir, 'reading', '%04d.html' % year), key, 
+                xslt, template_loader, 'reading/archive.html', year=year, years=years, 
+                items=year_entries, config=config)
 
-    rendered = template_loader.load('reading.html').generate(items=entries,
-            config=config).render('xhtml')
-    transformed = str(xslt(lxml.etree.fromstring(rendered)))
-    constance.output(os.path.join(os.path.dirname(filename), 'reading.html'), transformed)
+    covers.generate(dir, entries, config, jobs=jobs)
 
     # feed
-    rendered = template_loader.load('reading.atom').generate(items=entries,
-            config=config).render('xml')
-    constance.output(os.path.join(os.path.dirname(filename), 'reading.atom'), rendered)
+    feeds.generate(template_loader, 'reading/reading.atom', os.path.join(dir, 'reading.atom'), 
+            entries.by_date, config, 'reading')
 
     return entries
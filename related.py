@@ -0,0 +1,281 @@
+# vim:fileencoding=utf-8
+
+# "Related entries" for each blog entry, scored by the cosine similarity of
+# the entries' tags and of the TF-IDF weighted terms in their text. Scores
+# are computed with sparse matrix products, a block of rows at a time.
+# Requires NumPy and SciPy; without them no entries are related.
+#
+# The term counts of every entry and each entry's top scores are cached on
+# disk, and only the entries whose vectors changed are scored again: each
+# against every entry, with its new scores pushed into the other entries'
+# lists. An entry whose list named a changed or removed entry is rescored
+# too. So that one edit doesn't change the weight of every term, document
+# frequencies are rounded down to a power of two and the entry count up to
+# one: a term's weight only changes when its frequency crosses a power of
+# two, and everything is rescored when the number of entries does. Both
+# depend on the entries alone, and a score comes out the same however the
+# rows are blocked, so the lists never depend on the order of edits.
+
+import re
+import hashlib
+from itertools import izip
+
+try:
+    import numpy
+    import scipy.sparse
+except ImportError:
+    numpy = None
+
+import cache
+import manifest
+import stats
+
+TAG_WEIGHT = 0.5
+TERM_WEIGHT = 0.5
+BLOCK_SIZE = 256
+TERMS_VERSION = '1'
+MODEL_VERSION = '1'
+TERM_PATT = re.compile(r'(?u)[^\W\d_]{3,}')
+
+def entry_terms(entry):
+    """
+    Returns a dict of term counts for the entry's title and body source,
+    cached on disk by content.
+    """
+    key = hashlib.sha1(entry.source_hash + TERMS_VERSION).hexdigest()
+    terms = cache.get('related-terms', key)
+    if terms is None:
+        source = open(entry.content_filename, 'r').read().decode('utf8')
+        text = entry.metadata['title'] + u' ' + source.split(u'\n\n', 1)[-1]
+        terms = {}
+        for term in TERM_PATT.findall(text.lower()):
+            terms[term] = terms.get(term, 0) + 1
+        cache.put('related-terms', key, terms)
+    return terms
+
+def _normalized_rows(rows, cols, values, shape):
+    m = scipy.sparse.csr_matrix((values, (rows, cols)), shape=shape, dtype=numpy.float32)
+    norms = numpy.sqrt(numpy.asarray(m.multiply(m).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return scipy.sparse.diags(1 / norms) * m
+
+def _term_counts(entries, model):
+    """
+    Returns (vocabulary, counts): the sorted terms the entries use, and the 
+    log of each term's count with a row per entry and a column per term. 
+    Rows of entries which are unchanged since the model was saved are taken 
+    from it.
+    """
+    model_rows = {}
+    if model is not None:
+        model_rows = dict(((id, hash), i) for i, (id, hash) 
+                in enumerate(izip(model['ids'], model['hashes'])))
+    reused = []
+    parsed = []
+    words = set(model is not None and model['vocabulary'] or ())
+    for i, entry in enumerate(entries):
+        row = model_rows.get((entry.id, entry.source_hash))
+        if row is None:
+            terms = entry_terms(entry)
+            parsed.append((i, terms))
+            words.update(terms)
+        else:
+            reused.append((i, row))
+    vocabulary = sorted(words)
+    columns = dict((term, j) for j, term in enumerate(vocabulary))
+
+    rows, cols, values = [], [], []
+    for i, terms in parsed:
+        # in a fixed order, so scores are summed in the same order every time
+        for term, count in sorted(terms.iteritems()):
+            rows.append(i)
+            cols.append(columns[term])
+            values.append(count)
+    rows = [numpy.array(rows, dtype=numpy.int32)]
+    cols = [numpy.array(cols, dtype=numpy.int32)]
+    values = [numpy.log1p(numpy.array(values, dtype=numpy.float32))]
+    if reused:
+        new_rows, old_rows = (numpy.array(a) for a in zip(*reused))
+        old = model['counts'][old_rows].tocoo()
+        remap = numpy.array([columns[term] for term in model['vocabulary']])
+        rows.append(new_rows[old.row])
+        cols.append(remap[old.col])
+        values.append(old.data)
+    counts = scipy.sparse.csr_matrix((numpy.concatenate(values), 
+            (numpy.concatenate(rows), numpy.concatenate(cols))), 
+            shape=(len(entries), len(vocabulary)), dtype=numpy.float32)
+    # drop the terms only removed or changed entries used
+    used = numpy.bincount(counts.indices, minlength=len(vocabulary)) > 0
+    if not used.all():
+        counts = counts[:, numpy.nonzero(used)[0]]
+        vocabulary = [term for term, is_used in izip(vocabulary, used) if is_used]
+    counts.sort_indices()
+    return vocabulary, counts
+
+def _idf(counts):
+    """
+    Returns the inverse document frequency of each term (column of counts),
+    with frequencies rounded down and the entry count rounded up to powers
+    of two.
+    """
+    n = counts.shape[0]
+    df = numpy.bincount(counts.indices, minlength=counts.shape[1])
+    mantissas, exponents = numpy.frexp(df.astype(numpy.float64))
+    return numpy.log((1 << (n - 1).bit_length()) / 
+            numpy.ldexp(1.0, exponents - 1)).astype(numpy.float32)
+
+def _matrices(counts, idf, entries):
+    tfidf = (counts * scipy.sparse.diags(idf)).tocoo()
+    terms = _normalized_rows(tfidf.row, tfidf.col, tfidf.data, tfidf.shape)
+
+    rows, cols = [], []
+    tag_ids = dict((tag, j) for j, tag in 
+            enumerate(sorted(set(tag for entry in entries for tag in entry.tags))))
+    for i, entry in enumerate(entries):
+        for tag in sorted(entry.tags):
+            rows.append(i)
+            cols.append(tag_ids[tag])
+    tags = _normalized_rows(rows, cols, numpy.ones(len(rows)), 
+            (len(entries), max(len(tag_ids), 1)))
+    return terms, tags
+
+def _similarity(matrix, by_column, block):
+    # sparse by dense is much faster than sparse by sparse when the product 
+    # is dense, and only the columns (terms or tags) the block uses matter
+    rows = matrix[block]
+    columns = numpy.unique(rows.indices)
+    return (by_column[:, columns] * rows[:, columns].T.toarray()).T
+
+def _similarity_blocks(terms, tags, indices):
+    """
+    Yields (row indices, dense similarity block) for the given rows against
+    every entry, BLOCK_SIZE rows at a time, with self-similarity zeroed.
+    """
+    terms_by_column = terms.tocsc()
+    tags_by_column = tags.tocsc()
+    for start in xrange(0, len(indices), BLOCK_SIZE):
+        block = numpy.array(indices[start:start + BLOCK_SIZE])
+        scores = (TERM_WEIGHT * _similarity(terms, terms_by_column, block) +
+                TAG_WEIGHT * _similarity(tags, tags_by_column, block))
+        scores[numpy.arange(len(block)), block] = 0
+        yield block, scores
+
+def _top(scores, count):
+    """
+    Returns the indices of the (at most) count highest positive scores,
+    highest first, without sorting the whole row. Ties go to the lower index
+    (the earlier entry), so the result doesn't depend on how it was computed.
+    """
+    if count < len(scores):
+        threshold = scores[numpy.argpartition(-scores, count - 1)[count - 1]]
+        candidates = numpy.nonzero(scores >= threshold)[0]
+    else:
+        candidates = numpy.arange(len(scores))
+    candidates = candidates[scores[candidates] > 0]
+    return candidates[numpy.lexsort((candidates, -scores[candidates]))][:count]
+
+def _score(entries, count, model):
+    """
+    Returns a new model for the entries (sorted by id): their term counts, 
+    and a list of (id, score) of related entries for each, scoring only the 
+    entries whose vectors changed since the given model (if any) was saved.
+    """
+    ids = [entry.id for entry in entries]
+    vocabulary, counts = _term_counts(entries, model)
+    idf = _idf(counts)
+    terms, tags = _matrices(counts, idf, entries)
+
+    previous = {}
+    changed = numpy.ones(len(ids), dtype=bool)
+    rescore = changed
+    if model is not None:
+        previous = model['related']
+        old_hashes = dict(izip(model['ids'], model['hashes']))
+        changed = numpy.array([old_hashes.get(entry.id) != entry.source_hash 
+                for entry in entries])
+        old_idf = dict(izip(model['vocabulary'], model['idf']))
+        reweighted = numpy.array([old_idf.get(term) != weight 
+                for term, weight in izip(vocabulary, idf)], dtype=bool)
+        if reweighted.any():
+            changed[counts.tocsc()[:, numpy.nonzero(reweighted)[0]].indices] = True
+        stale = set(id for id, is_changed in izip(ids, changed) if is_changed)
+        stale.update(set(old_hashes) - set(ids))
+        rescore = changed | numpy.array([any(other in stale for other, score in 
+                previous.get(id, ())) for id in ids], dtype=bool)
+
+    # an entry which isn't rescored keeps its list, unless a changed entry 
+    # now scores at least as high as the last on it
+    keep = ~rescore
+    thresholds = numpy.zeros(len(ids), dtype=numpy.float32)
+    for i in numpy.nonzero(keep)[0]:
+        listed = previous[ids[i]]
+        if len(listed) == count:
+            thresholds[i] = listed[-1][1]
+    candidates = {}
+    related = {}
+    for block, scores in _similarity_blocks(terms, tags, numpy.nonzero(rescore)[0]):
+        for row, row_scores in izip(block, scores):
+            related[ids[row]] = [(ids[j], float(row_scores[j])) 
+                    for j in _top(row_scores, count)]
+        pushed = changed[block]
+        if pushed.any() and keep.any():
+            # similarity is symmetric, so these are the changed entries' 
+            # scores in every other entry's row
+            block, scores = block[pushed], scores[pushed]
+            for row, i in izip(*numpy.nonzero((scores > 0) & 
+                    (scores >= thresholds) & keep)):
+                candidates.setdefault(i, []).append(
+                        (ids[block[row]], float(scores[row, i])))
+    for i in numpy.nonzero(keep)[0]:
+        listed = previous[ids[i]]
+        if i in candidates:
+            listed = sorted(listed + candidates[i], 
+                    key=lambda (other, score): (-score, other))[:count]
+        related[ids[i]] = listed
+    return {'ids': ids, 'hashes': [entry.source_hash for entry in entries], 
+            'vocabulary': vocabulary, 'counts': counts, 'idf': idf, 
+            'related': related}
+
+# the model saved by the last build, as (signature, model), so that --watch
+# doesn't read it back from the cache
+_model = None
+
+def related_entries(entries, count):
+    """
+    Returns a dict mapping each entry's id to a list of (at most) count
+    related entries, most related first.
+    """
+    global _model
+    if numpy is None or count <= 0 or len(entries) < 2:
+        return {}
+    with stats.timed('related'):
+        entries = sorted(entries, key=lambda entry: entry.id)
+        parameters = (count, TAG_WEIGHT, TERM_WEIGHT, TERMS_VERSION, MODEL_VERSION)
+        signature = hashlib.sha1(repr((parameters, 
+                [(entry.id, entry.source_hash) for entry in entries]))).hexdigest()
+
+        previous = manifest.previous_state.get('related')
+        if previous is not None and previous['signature'] == signature:
+            scored = previous['related']
+        else:
+            model = None
+            if previous is not None:
+                if _model is not None and _model[0] == previous['signature']:
+                    model = _model[1]
+                else:
+                    model = cache.get('related-model', previous['signature'])
+                if model is not None and model.get('parameters') != parameters:
+                    model = None
+            model = _score(entries, count, model)
+            model['parameters'] = parameters
+            cache.put('related-model', signature, model)
+            if previous is not None:
+                cache.remove('related-model', previous['signature'])
+            _model = (signature, model)
+            scored = dict((id, [other for other, score in listed]) 
+                    for id, listed in model['related'].iteritems())
+
+        manifest.state['related'] = {'signature': signature, 'related': scored}
+        by_id = dict((entry.id, entry) for entry in entries)
+        return dict((id, [by_id[other] for other in related])
+                for id, related in scored.iteritems())
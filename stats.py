@@ -0,0 +1,151 @@
+# vim:fileencoding=utf-8
+
+# Wall time and call counts for each stage of the build, broken down by the
+# generator which was running at the time, and the peak memory use of each
+# generator. Enabled by --stats.
+
+import sys
+import time
+import json
+
+enabled = False
+generator = 'main'
+timings = {} # (generator, stage) -> [calls, seconds]
+counters = {} # (generator, counter) -> value
+peaks = {} # (generator, 'process' or 'workers') -> peak RSS in kB
+
+def _reset_peak_rss():
+    # on Linux, writing 5 to clear_refs resets VmHWM to the current RSS, so
+    # that it shows the peak since then rather than since the process started
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+        return True
+    except IOError:
+        return False
+
+def _peak_rss():
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+def _record_peak(k, value):
+    if value is not None and value > peaks.get(k, 0):
+        peaks[k] = value
+
+class _Timer(object):
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        timing = timings.setdefault((generator, self.stage), [0, 0.0])
+        timing[0] += 1
+        timing[1] += time.time() - self.start
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+_null_timer = _NullTimer()
+
+def timed(stage):
+    if not enabled:
+        return _null_timer
+    return _Timer(stage)
+
+class generating(object):
+    """
+    Attributes everything recorded inside the with-block to the named
+    generator.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        global generator
+        self.previous = generator
+        generator = self.name
+        if enabled:
+            self.measure_peak = _reset_peak_rss()
+            self.start = time.time()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        global generator
+        if enabled:
+            timing = timings.setdefault((generator, 'total'), [0, 0.0])
+            timing[0] += 1
+            timing[1] += time.time() - self.start
+            if self.measure_peak:
+                _record_peak((generator, 'process'), _peak_rss())
+        generator = self.previous
+
+def count(counter, n=1):
+    if enabled:
+        counters[(generator, counter)] = counters.get((generator, counter), 0) + n
+
+def reset():
+    timings.clear()
+    counters.clear()
+    peaks.clear()
+
+def take():
+    """
+    Returns everything recorded so far (in a form which can be passed to
+    merge, possibly in another process) and resets. The peak RSS of the 
+    process is included, to be merged as that of a worker.
+    """
+    taken = (dict(timings), dict(counters), enabled and _peak_rss() or None)
+    reset()
+    return taken
+
+def merge(taken):
+    other_timings, other_counters, worker_peak = taken
+    _record_peak((generator, 'workers'), worker_peak)
+    for k, (calls, seconds) in other_timings.iteritems():
+        timing = timings.setdefault(k, [0, 0.0])
+        timing[0] += calls
+        timing[1] += seconds
+    for k, value in other_counters.iteritems():
+        counters[k] = counters.get(k, 0) + value
+
+def report():
+    result = {}
+    def details(generator):
+        return result.setdefault(generator, 
+                {'stages': {}, 'counters': {}, 'peak_rss_kb': {}})
+    for (generator, stage), (calls, seconds) in timings.iteritems():
+        details(generator)['stages'][stage] = {'calls': calls, 'seconds': seconds}
+    for (generator, counter), value in counters.iteritems():
+        details(generator)['counters'][counter] = value
+    for (generator, process), value in peaks.iteritems():
+        details(generator)['peak_rss_kb'][process] = value
+    return result
+
+def print_report(out=sys.stdout):
+    print >>out, 'Build statistics (times include nested stages):'
+    for generator, details in sorted(report().iteritems()):
+        print >>out, generator
+        for stage, timing in sorted(details['stages'].iteritems()):
+            print >>out, '    %-24s %8d calls %10.3fs' % (stage, timing['calls'], timing['seconds'])
+        for counter, value in sorted(details['counters'].iteritems()):
+            print >>out, '    %-24s %8d' % (counter, value)
+        for process, value in sorted(details['peak_rss_kb'].iteritems()):
+            print >>out, '    %-24s %8.1f MB' % ('peak RSS (%s)' % process, value / 1024.0)
+
+def write_json(filename):
+    with open(filename, 'w') as fp:
+        json.dump(report(), fp, indent=4, sort_keys=True)
@@ -2,29 +2,109 @@
 # vim:fileencoding=utf-8
 
 import os
-import genshi.template
 import lxml.etree
 
 import constance
+import feeds
+import manifest
 import viewutils
+from loader import template_loader
 
-template_loader = genshi.template.TemplateLoader(
-        os.path.join(os.path.realpath(os.path.dirname(__file__)), 'templates', 'tags'), 
-        variable_lookup='strict')
+class TagIndex(object):
+    """
+    Inverted index from each tag to its entries, newest first, built in a 
+    single pass over the entries (which must be newest first).
+    """
+
+    def __init__(self, entries):
+        self.entries_by_tag = {}
+        for entry in entries:
+            for tag in entry.tags:
+                self.entries_by_tag.setdefault(tag, []).append(entry)
+
+    def __iter__(self):
+        return iter(self.entries_by_tag)
+
+    def __len__(self):
+        return len(self.entries_by_tag)
+
+    def __getitem__(self, tag):
+        return self.entries_by_tag[tag]
+
+    def frequencies(self):
+        return dict((tag, len(tagged_entries)) 
+                for tag, tagged_entries in self.entries_by_tag.iteritems())
 
 def generate(dir, xslt, blog_entries, config):
-    tag_freqs = {}
-    for entry in blog_entries:
-        for tag in entry.tags:
-            tag_freqs[tag] = tag_freqs.get(tag, 0) + 1
-
-    for tag in tag_freqs.keys():
-        tagged_entries = [e for e in blog_entries if tag in e.tags]
-        rendered = template_loader.load('tag.html').generate(tag=tag, items=tagged_entries).render('xhtml')
-        transformed = str(xslt(lxml.etree.fromstring(rendered)))
-        constance.output(os.path.join(dir, tag.encode('utf8') + '.html'), transformed)
-
-    rendered = template_loader.load('index.html').generate(tag_freqs=tag_freqs,
-            config=config).render('xhtml')
-    transformed = str(xslt(lxml.etree.fromstring(rendered)))
-    constance.output(os.path.join(dir, 'index.html'), transformed)
+    tag_index = TagIndex(blog_entries.by_date)
+
+    # Only tags which gained or lost an entry, or one of whose entries 
+    # changed, are regenerated. For the rest, the pages written by the 
+    # previous build are carried forward without computing their keys.
+    per_page = config.getint('tags', 'index_entries')
+    previous_tags = manifest.previous_state.get('tags', {})
+    tags_state = {}
+    for tag in tag_index:
+        members = [(e.id, manifest.key('tags/member', e.title, e.publication_date, 
+                e.source_hash, e.modified_date)) for e in tag_index[tag]]
+        previous_members, previous_outputs = previous_tags.get(tag, (None, []))
+        if members == previous_members and manifest.carry_forward(previous_outputs):
+            outputs = previous_outputs
+        else:
+            outputs = generate_tag_pages(dir, xslt, tag, tag_index[tag], per_page, config)
+        tags_state[tag] = (members, outputs)
+    manifest.state['tags'] = tags_state
+
+    tag_freqs = tag_index.frequencies()
+    filename = os.path.join(dir, 'index.html')
+    key = manifest.key('tags/index.html', sorted(tag_freqs.items()))
+    constance.generate_page(filename, key, xslt, template_loader, 'tags/index.html', 
+            tag_freqs=tag_freqs, config=config)
+
+    return tag_index
+
+def tag_page_filename(dir, tag, number=None):
+    if number is None:
+        return os.path.join(dir, tag.encode('utf8') + '.html')
+    return os.path.join(dir, '%s-page-%d.html' % (tag.encode('utf8'), number))
+
+def generate_tag_pages(dir, xslt, tag, tagged_entries, per_page, config):
+    """
+    Writes the tag's page, listing its most recent entries, numbered pages 
+    holding the rest, and its feed. Numbered pages are filled from the oldest entry 
+    onwards, so they do not change as new entries are tagged. Tagged entries 
+    must be newest first, as in TagIndex. Returns the filenames of the pages.
+    """
+    if per_page > 0:
+        pages = feeds.archive_pages(reversed(tagged_entries), per_page)
+        recent = tagged_entries[:per_page]
+    else:
+        pages = []
+        recent = tagged_entries
+    filenames = []
+    for i, page_entries in enumerate(pages):
+        page_entries.reverse()
+        number = i + 1
+        older = number > 1 and number - 1 or None
+        newer = number < len(pages) and number + 1 or None
+        key = manifest.key('tags/tag.html', tag, number, older, newer, 
+                [(e.id, e.title, e.publication_date) for e in page_entries])
+        filename = tag_page_filename(dir, tag, number)
+        constance.generate_page(filename, key, xslt, 
+                template_loader, 'tags/tag.html', tag=tag, items=page_entries, 
+                page_number=number, older=older, newer=newer, page_numbers=[])
+        filenames.append(filename)
+    page_numbers = range(len(pages), 0, -1)
+    key = manifest.key('tags/tag.html', tag, page_numbers, 
+            [(e.id, e.title, e.publication_date) for e in recent])
+    filename = tag_page_filename(dir, tag)
+    constance.generate_page(filename, key, xslt, template_loader, 
+            'tags/tag.html', tag=tag, items=recent, page_number=None, older=None, 
+            newer=None, page_numbers=page_numbers)
+    filenames.append(filename)
+
+    # feed, made from the same entry.atom fragments as the blog feed
+    filenames.extend(feeds.generate(template_loader, 'tags/tag.atom', 
+            os.path.join(dir, tag.encode('utf8') + '.atom'), tagged_entries, 
+            config, 'tags', archive=False, tag=tag))
+    return filenames
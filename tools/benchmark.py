@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+# Generates a synthetic site of a given size in a temporary directory, builds
+# it and reports wall time and peak RSS per generator. Peak RSS is measured
+# separately for each generator only on Linux (see stats.py).
+
+import os, sys, time, random, shutil, tempfile, codecs
+from datetime import datetime, timedelta
+from ConfigParser import SafeConfigParser
+from optparse import Values
+
+package_dir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, package_dir)
+sys.path.insert(1, os.path.join(package_dir, 'lib'))
+
+import lxml.etree
+
+import constance
+import stats
+import blog
+import reading
+
+PRESETS = {
+    'small': (100, 500),
+    'medium': (5000, 10000),
+    'large': (50000, 30000),
+}
+
+WORDS = ('the quick brown fox jumps over lazy dog python static site '
+        'generator markdown template entry feed archive build cache page '
+        'reading book author review thought idea code release bug fix '
+        'performance memory disk network server client request response').split()
+
+def sentence(rng, min_words=6, max_words=18):
+    words = [rng.choice(WORDS) for _ in xrange(rng.randint(min_words, max_words))]
+    for i in xrange(len(words)):
+        r = rng.random()
+        if r < 0.03:
+            words[i] = '*%s*' % words[i]
+        elif r < 0.05:
+            words[i] = '**%s**' % words[i]
+        elif r < 0.07:
+            words[i] = '`%s()`' % words[i]
+        elif r < 0.09:
+            words[i] = '[%s](http://example.com/%s)' % (words[i], words[i])
+    return ' '.join(words).capitalize() + '.'
+
+def markdown_body(rng):
+    blocks = []
+    for _ in xrange(rng.randint(3, 12)):
+        r = rng.random()
+        if r < 0.1:
+            blocks.append('## ' + sentence(rng, 2, 5).rstrip('.'))
+        elif r < 0.2:
+            blocks.append('\n'.join('* ' + sentence(rng, 3, 8)
+                    for _ in xrange(rng.randint(2, 6))))
+        elif r < 0.3:
+            blocks.append('\n'.join('    ' + ' '.join(rng.choice(WORDS)
+                    for _ in xrange(rng.randint(2, 8)))
+                    for _ in xrange(rng.randint(2, 10))))
+        elif r < 0.35:
+            blocks.append('> ' + sentence(rng))
+        else:
+            blocks.append(' '.join(sentence(rng) for _ in xrange(rng.randint(2, 7))))
+    return '\n\n'.join(blocks) + '\n'
+
+def tag_vocabulary(n):
+    return ['tag%d' % i for i in xrange(n)]
+
+def choose_tags(rng, vocabulary):
+    # a few tags are very common and most are rare, as in real blogs
+    count = min(len(vocabulary), int(rng.paretovariate(1.5)))
+    return set(vocabulary[min(len(vocabulary) - 1, int(rng.paretovariate(1.2)) - 1)]
+            for _ in xrange(count))
+
+def generate_site(root, num_entries, num_reading_entries, num_tags, seed):
+    rng = random.Random(seed)
+    start = datetime(2000, 1, 1)
+    vocabulary = tag_vocabulary(num_tags)
+    for dir in ['blog', 'tags']:
+        os.mkdir(os.path.join(root, dir))
+
+    for i in xrange(num_entries):
+        date = start + timedelta(minutes=rng.randint(0, 60 * 24 * 365 * 10))
+        with open(os.path.join(root, 'blog', 'entry-%d.txt' % i), 'w') as fp:
+            fp.write('Title: %s\n' % sentence(rng, 2, 8).rstrip('.'))
+            fp.write('GUID: urn:uuid:benchmark-entry-%d\n' % i)
+            fp.write('Publication-Date: %s\n' % date.strftime('%Y-%m-%d %H:%M:%S'))
+            entry_tags = choose_tags(rng, vocabulary)
+            if entry_tags:
+                fp.write('Tags: %s\n' % ', '.join(sorted(entry_tags)))
+            fp.write('\n')
+            fp.write(markdown_body(rng))
+
+    with open(os.path.join(root, 'reading_log.yaml'), 'w') as fp:
+        for i in xrange(num_reading_entries):
+            date = start + timedelta(minutes=rng.randint(0, 60 * 24 * 365 * 10))
+            fp.write('---\n')
+            fp.write('Title: "%s"\n' % sentence(rng, 1, 6).rstrip('.'))
+            fp.write('Author: Author %d\n' % rng.randint(0, num_reading_entries // 3 + 1))
+            fp.write('Date: %s\n' % date.strftime('%Y-%m-%d %H:%M:%S'))
+            if rng.random() < 0.7:
+                fp.write('ISBN: "%010d"\n' % rng.randint(0, 10 ** 10 - 1))
+            if rng.random() < 0.5:
+                fp.write('URL: http://example.com/book/%d\n' % i)
+            if rng.random() < 0.8:
+                fp.write('Rating: %.1f\n' % (rng.randint(0, 10) / 2.0))
+            fp.write('GUID: urn:uuid:benchmark-reading-%d\n' % i)
+
+    shutil.copy(os.path.join(package_dir, 'sample.xsl'), os.path.join(root, 'sample.xsl'))
+
+def make_config(root):
+    config = SafeConfigParser(constance.CONFIG_DEFAULTS)
+    with codecs.open(os.path.join(package_dir, 'constance.conf.sample'), 'r', 'utf8') as fp:
+        config.readfp(fp)
+    config.set('global', 'root', root)
+    config.set('global', 'xslt', 'sample.xsl')
+    return config
+
+def forget_parsed_entries():
+    # what a fresh constance process would start with (as opposed to --watch)
+    blog._entry_cache.clear()
+    reading._entry_set = None
+
+def build(config, jobs, force):
+    """
+    Runs constance.build with stats enabled and returns (generator, seconds,
+    peak RSS in kB, peak RSS of its worker processes in kB) for each 
+    generator which ran.
+    """
+    options = Values({'force': force, 'jobs': jobs, 'stats': False, 'stats_json': None})
+    xslt = lxml.etree.XSLT(lxml.etree.parse(config.get('global', 'xslt')))
+    stats.enabled = True
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        constance.build(config, options, xslt)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    report = stats.report()
+    results = []
+    for name in constance.STAGES + ('precompress',):
+        if name in report:
+            details = report[name]
+            results.append((name, details['stages']['total']['seconds'],
+                    details['peak_rss_kb'].get('process'),
+                    details['peak_rss_kb'].get('workers')))
+    return results
+
+def format_rss(rss):
+    if rss is None:
+        return '%10s   ' % '-'
+    return '%10.1f MB' % (rss / 1024.0)
+
+def print_results(title, results):
+    print title
+    print '    %-12s %11s %13s %13s' % ('', 'time', 'peak RSS', 'workers')
+    for name, elapsed, rss, worker_rss in results:
+        print '    %-12s %10.3fs %s %s' % (name, elapsed, format_rss(rss), 
+                format_rss(worker_rss))
+    print '    %-12s %10.3fs' % ('total', sum(r[1] for r in results))
+
+def main(options):
+    if options.preset:
+        options.entries, options.reading_entries = PRESETS[options.preset]
+    root = options.keep or tempfile.mkdtemp(prefix='constance-benchmark-')
+    if not os.path.exists(root):
+        os.makedirs(root)
+    try:
+        start = time.time()
+        generate_site(root, options.entries, options.reading_entries,
+                options.tags, options.seed)
+        print 'Generated %d blog entries and %d reading log entries in %s (%.1fs)' % (
+                options.entries, options.reading_entries, root, time.time() - start)
+        config = make_config(root)
+        os.chdir(root)
+        print_results('Full build:', build(config, options.jobs, force=True))
+        for _ in xrange(options.rebuilds):
+            if not options.warm:
+                forget_parsed_entries()
+            print_results('No-op rebuild:', build(config, options.jobs, force=False))
+    finally:
+        os.chdir(package_dir)
+        if not options.keep:
+            shutil.rmtree(root)
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option('--preset', choices=sorted(PRESETS.keys()),
+            help='site size: %s' % ', '.join('%s (%d entries, %d books)' % (name, e, r)
+                for name, (e, r) in sorted(PRESETS.items())))
+    parser.add_option('-n', '--entries', type='int',
+            help='number of blog entries [default: %default]')
+    parser.add_option('-r', '--reading-entries', type='int',
+            help='number of reading log entries [default: %default]')
+    parser.add_option('-t', '--tags', type='int',
+            help='size of the tag vocabulary [default: %default]')
+    parser.add_option('-j', '--jobs', type='int',
+            help='worker processes for blog entries [default: %default]')
+    parser.add_option('--rebuilds', type='int',
+            help='number of no-op rebuilds to time after the full build [default: %default]')
+    parser.add_option('--warm', action='store_true',
+            help='keep parsed entries in memory between builds, as --watch does')
+    parser.add_option('--seed', type='int',
+            help='random seed for the synthetic site [default: %default]')
+    parser.add_option('--keep', metavar='DIR',
+            help='generate the site in DIR and keep it afterwards')
+    parser.set_defaults(entries=100, reading_entries=500, tags=200, jobs=1,
+            rebuilds=1, warm=False, seed=0, keep=None)
+    options, args = parser.parse_args()
+    main(options)
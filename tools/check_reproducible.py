@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+# Builds a site twice from scratch, in two copies of its root directory, and
+# reports any generated files which differ between the two builds. Output
+# must be reproducible, or pages whose inputs have not changed are rewritten
+# on every build anyway. The second build uses worker processes, so that
+# anything which depends on the process is caught too.
+
+import os, sys, shutil, tempfile, subprocess
+from ConfigParser import RawConfigParser
+
+package_dir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+
+def copy_site(config_filename, dir):
+    """
+    Copies the site's root directory, without its manifest and cache, to dir
+    and writes a config for building it there. Returns the config filename.
+    """
+    # read as bytes, so the config can be written out unchanged
+    config = RawConfigParser()
+    config.read(config_filename)
+    root = os.path.abspath(config.get('global', 'root') or '.')
+    excluded = []
+    for option in ['manifest', 'cache_dir']:
+        if config.has_option('global', option):
+            excluded.append(os.path.basename(config.get('global', option)))
+            config.remove_option('global', option)
+    excluded.extend(['.constance-manifest', '.constance-cache'])
+    shutil.copytree(root, os.path.join(dir, 'root'),
+            ignore=shutil.ignore_patterns(*excluded))
+    config.set('global', 'root', os.path.join(dir, 'root'))
+    # these are relative to the original root
+    config.set('global', 'xslt', os.path.join(root, config.get('global', 'xslt')))
+    if config.has_option('reading', 'covers_dir') and config.get('reading', 'covers_dir'):
+        config.set('reading', 'covers_dir',
+                os.path.join(root, config.get('reading', 'covers_dir')))
+    filename = os.path.join(dir, 'constance.conf')
+    with open(filename, 'w') as fp:
+        config.write(fp)
+    return filename
+
+def build(config_filename, jobs):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, os.path.join(package_dir, 'constance.py'),
+                '--config', config_filename, '--force', '--jobs', str(jobs)],
+                stdout=devnull)
+
+def files(root):
+    result = set()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d != '.constance-cache']
+        for filename in filenames:
+            if not filename.startswith('.constance-manifest'):
+                result.add(os.path.relpath(os.path.join(dirpath, filename), root))
+    return result
+
+def differences(a, b):
+    """
+    Yields the relative path of each file which differs between directories
+    a and b, or is only in one of them.
+    """
+    files_a, files_b = files(a), files(b)
+    for path in sorted(files_a | files_b):
+        if path not in files_a or path not in files_b:
+            yield path
+        elif open(os.path.join(a, path), 'rb').read() != \
+                open(os.path.join(b, path), 'rb').read():
+            yield path
+
+def main(options):
+    config_filename = os.path.expanduser(options.config)
+    dir = tempfile.mkdtemp(prefix='constance-reproducible-')
+    try:
+        first = copy_site(config_filename, os.path.join(dir, 'first'))
+        second = copy_site(config_filename, os.path.join(dir, 'second'))
+        print 'Building twice in %s' % dir
+        build(first, 1)
+        build(second, options.jobs)
+        different = list(differences(os.path.join(dir, 'first', 'root'),
+                os.path.join(dir, 'second', 'root')))
+        for path in different:
+            print 'Differs: %s' % path
+        if different:
+            print '%d files differ between the builds' % len(different)
+        else:
+            print 'The builds are identical'
+    finally:
+        if options.keep:
+            print 'Kept both builds in %s' % dir
+        else:
+            shutil.rmtree(dir)
+    return different and 1 or 0
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option('--config', metavar='FILENAME',
+            help='the site to build [default: %default]')
+    parser.add_option('-j', '--jobs', type='int',
+            help='worker processes for the second build [default: %default]')
+    parser.add_option('--keep', action='store_true',
+            help='keep both builds afterwards, to compare the differences')
+    parser.set_defaults(config='~/.constance.conf', jobs=2, keep=False)
+    options, args = parser.parse_args()
+    sys.exit(main(options))
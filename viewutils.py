@@ -1,14 +1,24 @@
 import re, urllib
+import markdown2
 from markdown2 import Markdown
 import genshi
 
+import stats
+
+MARKDOWN_EXTRAS = ['code_friendly']
+# identifies how Markdown is converted, for keying cached conversions
+MARKDOWN_SIGNATURE = 'markdown2 %s extras=%s' % (markdown2.__version__, 
+        ','.join(MARKDOWN_EXTRAS))
+
 def markdown(s, safe_mode=None):
-    m = Markdown(extras=['code_friendly'], safe_mode=safe_mode).convert(s)
+    with stats.timed('markdown'):
+        m = Markdown(extras=MARKDOWN_EXTRAS, safe_mode=safe_mode).convert(s)
     return genshi.Markup(m)
 
 def mini_markdown(s, safe_mode=None):
     # XXX find a more efficient way to do this?
-    m = Markdown(extras=['code_friendly']).convert(s)
+    with stats.timed('mini_markdown'):
+        m = Markdown(extras=MARKDOWN_EXTRAS).convert(s)
     match = re.match(u'<p>(.*)</p>', m)
     assert match, m
     return genshi.Markup(match.group(1))
@@ -22,8 +32,17 @@ def idify(s):
     return u''.join(c for c in s if IDIFY_ACCEPT_PATT.match(c))
 
 ATOM_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S+10:00'
+# the config values read by the blog and reading log entry.atom templates
+ATOM_ENTRY_CONFIG = (('global', 'name'), ('global', 'email'), ('global', 'url_base'))
+
+def tag_sort_key(tag):
+    return (tag.lower(), tag)
+
+def sorted_tags(tags):
+    # tags are sets, whose order can differ from one run to the next
+    return sorted(tags, key=tag_sort_key)
 
 def tag_list(tags):
     return genshi.Markup(u', ').join(
             genshi.Markup(u'<a rel="tag" href="/tags/%s">%s</a>' % (urllib.quote(tag.encode('utf8'), ''), tag)) 
-            for tag in tags)
+            for tag in sorted_tags(tags))